@@ -1,15 +1,24 @@
-from typing import List
+from typing import List, Literal, Optional
 import asyncio
 import logging
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
+import orjson
 
 from .readers.reader_manager import ReaderManager
+from .mongodb_service import MongoDBService
 from .auth import get_current_user
 from .util import async_wake_up_worker
+from .feeds.feed_item import FeedItem
+
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:  # brotli is optional, gzip is always available
+    BrotliMiddleware = None
 
 
 class PortfolioSetting(BaseModel):
@@ -18,7 +27,34 @@ class PortfolioSetting(BaseModel):
 
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+class CompressionMiddleware:
+    """
+    Compress large responses with brotli if installed, otherwise gzip, as negotiated
+    by Accept-Encoding. Streaming endpoints are passed through so that feeds are not
+    held back in the compressor.
+    """
+
+    def __init__(self, app, minimum_size: int = 1000, excluded_paths=("/stream",)):
+        self.app = app
+        self.excluded_paths = excluded_paths
+        if BrotliMiddleware is not None:
+            self.compressed_app = BrotliMiddleware(
+                app, minimum_size=minimum_size, gzip_fallback=True
+            )
+        else:
+            self.compressed_app = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not scope["path"].startswith(
+            self.excluded_paths
+        ):
+            await self.compressed_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins="*",  # Allow all origins
@@ -26,10 +62,96 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
 
 reader_manager = ReaderManager()
 
 
+def parse_fields(fields: Optional[str]):
+    """
+    Parse a comma-separated field projection, e.g. "title,url,source"
+    """
+    if not fields:
+        return None
+    return {field.strip() for field in fields.split(",") if field.strip()}
+
+
+def render_feed(feed: FeedItem, fields: Optional[set], view: str):
+    if fields is not None:
+        return feed.to_dict(fields)
+    elif view == "card":
+        return feed.to_card()
+    else:
+        return feed.to_dict()
+
+
+QUEUE_SWEEP_INTERVAL = 300  # seconds
+READER_SYNC_INTERVAL = 30  # seconds between write-behind flushes of readers
+
+
+async def async_sweep_queues():
+    while True:
+        await asyncio.sleep(QUEUE_SWEEP_INTERVAL)
+        try:
+            reader_manager.sweep()
+        except Exception as e:
+            logger.error(f"Error sweeping queues: {e}")
+
+
+async def async_sync_readers():
+    while True:
+        await asyncio.sleep(READER_SYNC_INTERVAL)
+        try:
+            # only the blocking bulk write leaves the event loop
+            await reader_manager.async_sync()
+        except Exception as e:
+            logger.error(f"Error syncing readers: {e}")
+
+
+def prepare_feeds_collection():
+    feeds_db = MongoDBService("feeds")
+    try:
+        feeds_db.ensure_indexes()
+    finally:
+        feeds_db.disconnect()
+
+
+def backfill_feeds_collection():
+    # unscoped, so it scans the feeds collection; run after startup, not before
+    feeds_db = MongoDBService("feeds")
+    try:
+        feeds_db.backfill_subject_keys()
+    finally:
+        feeds_db.disconnect()
+
+
+async def async_backfill_feeds():
+    try:
+        await asyncio.to_thread(backfill_feeds_collection)
+    except Exception as e:
+        logger.error(f"Error backfilling the feeds collection: {e}")
+
+
+@app.on_event("startup")
+async def startup():
+    try:
+        await asyncio.to_thread(prepare_feeds_collection)
+    except Exception as e:
+        logger.error(f"Error preparing the feeds collection: {e}")
+    app.state.backfill_task = asyncio.create_task(async_backfill_feeds())
+    app.state.sweep_task = asyncio.create_task(async_sweep_queues())
+    app.state.sync_task = asyncio.create_task(async_sync_readers())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.backfill_task.cancel()
+    app.state.sweep_task.cancel()
+    app.state.sync_task.cancel()
+    await reader_manager.async_sync()
+    reader_manager.close()
+
+
 @app.get("/")
 def landing():
     return {
@@ -42,66 +164,56 @@ async def new(
     count: int,
     current_user: str = Depends(get_current_user),
 ):
-    reader = reader_manager[current_user]
+    reader = await reader_manager.async_get(current_user)
 
-    await reader.async_new(count)
+    await reader.async_new(count, budget=reader.LATENCY_BUDGET)
 
     return {"message": f"{count} feeds sampled and pushed to the queue"}
 
 
 @app.get("/pop")
 async def pop(
-    background_tasks: BackgroundTasks,
+    fields: Optional[str] = None,
+    view: Literal["full", "card"] = "full",
     current_user: str = Depends(get_current_user),
 ):
     # workaround to keep the worker warm when a user is using the service
     _ = asyncio.create_task(async_wake_up_worker())
 
-    reader = reader_manager[current_user]
+    reader = await reader_manager.async_get(current_user)
 
     feed = await reader.async_pop()
-    size = reader.queue.size()
-    refill_threshold = 50
-    refill_size = 50
-
-    async def refill_queue(refill_size: int):
-        await reader.async_new(refill_size)
-
-    if size < refill_threshold:
-        # Schedule the async_sample to run in the background
-        background_tasks.add_task(refill_queue, refill_size)
+    reader.refill()
 
     if feed:
-        response = {
-            "message": "The next feed is shown",
-        }
-        response.update(feed)
+        response = render_feed(feed, parse_fields(fields), view)
+        response["message"] = "The next feed is shown"
     else:
         response = {
             "message": "Error. We are pulling new feeds to the queue. Please wait for a few seconds!",
             "type": "error",
         }
-    return JSONResponse(content=response)
+    return ORJSONResponse(content=response)
 
 
 @app.get("/pop/{count}")
 async def pop_many(
     count: int = 1,
+    fields: Optional[str] = None,
+    view: Literal["full", "card"] = "full",
     current_user: str = Depends(get_current_user),
 ):
-    reader = reader_manager[current_user]
-
-    popped_feeds = []
+    reader = await reader_manager.async_get(current_user)
 
-    for _ in range(count):
-        feed = await reader.async_pop()
-        if feed:
-            popped_feeds.append(feed)
+    popped_feeds = await reader.async_pop_many(count)
+    reader.refill()
 
     if popped_feeds:
+        projection = parse_fields(fields)
         response = {
-            "message": f"{count} feed(s) popped successfully",
-            "feeds": popped_feeds,
+            "message": f"{len(popped_feeds)} feed(s) popped successfully",
+            "count": len(popped_feeds),
+            "feeds": [render_feed(feed, projection, view) for feed in popped_feeds],
         }
     else:
         response = {
@@ -109,14 +221,36 @@ async def pop_many(
             "type": "error",
         }
 
-    return JSONResponse(content=response)
+    return ORJSONResponse(content=response)
+
+
+@app.get("/stream/{count}")
+async def stream(
+    count: int,
+    fields: Optional[str] = None,
+    view: Literal["full", "card"] = "full",
+    current_user: str = Depends(get_current_user),
+):
+    """
+    Stream feeds as newline-delimited JSON: queued feeds first, then fresh feeds
+    as each source returns
+    """
+    reader = await reader_manager.async_get(current_user)
+    projection = parse_fields(fields)
+
+    async def generate():
+        async for feed in reader.async_stream(count, budget=reader.STREAM_BUDGET):
+            yield orjson.dumps(render_feed(feed, projection, view), default=str) + b"\n"
+        reader.refill()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 
 @app.get("/reset")
-def reset(
+async def reset(
     current_user: str = Depends(get_current_user),
 ):
-    reader = reader_manager[current_user]
+    reader = await reader_manager.async_get(current_user)
 
     reader.queue.clear()
 
@@ -124,11 +258,11 @@ def reset(
 
 
 @app.get("/portfolio")
-def show_portfolio(
+async def show_portfolio(
     current_user: str = Depends(get_current_user),
 ):
     try:
-        reader = reader_manager[current_user]
+        reader = await reader_manager.async_get(current_user)
 
         setting = reader.portfolio.get_setting()
         return {
@@ -143,17 +277,16 @@ def show_portfolio(
 
 
 @app.post("/portfolio")
-def update_portfolio(
+async def update_portfolio(
     body: PortfolioSetting,
     current_user: str = Depends(get_current_user),
 ):
     try:
-        reader = reader_manager[current_user]
+        reader = await reader_manager.async_get(current_user)
 
         setting = body.setting
-        reader.portfolio.load_setting(setting)
+        reader.portfolio.load_setting(setting)  # persisted by the next sync
 
-        reader_manager.sync()
         reader.queue.trim_last_until(10)
         return {"message": "Portfolio loaded successfully"}
     except Exception as e:
@@ -163,16 +296,15 @@ def update_portfolio(
 
 
 @app.get("/portfolio/reset")
-def reset_portfolio(
+async def reset_portfolio(
     current_user: str = Depends(get_current_user),
 ):
     try:
-        reader = reader_manager[current_user]
+        reader = await reader_manager.async_get(current_user)
 
         reader.portfolio.load_default()
         setting = reader.portfolio.get_setting()
 
-        reader_manager.sync()
         reader.queue.trim_last_until(10)
 
         return {
@@ -10,6 +10,7 @@ try:
 
 import logging
 
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
@@ -21,10 +22,30 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 # Secret key to sign and verify the JWT token
 SECRET_KEY = "secret"  # not signed by me
 
+# Decoded identities by bearer token, so repeated requests skip jwt.decode
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300  # seconds
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+token_cache_stats = {"hits": 0, "misses": 0}
+
 logger = logging.getLogger(__name__)
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    # async so that FastAPI resolves it on the event loop, not in its threadpool
+    user = token_cache.get(token)
+    if user is not None:
+        token_cache_stats["hits"] += 1
+        return user
+    token_cache_stats["misses"] += 1
+
+    user = decode_user(token)
+    if user is not None:  # invalid tokens are decoded again, not cached
+        token_cache[token] = user
+    return user
+
+
+def decode_user(token: str):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -59,6 +80,8 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
 if __name__ == "__main__":
     from .configs import TEST_BEARER_TOKEN
 
+    import asyncio
+
     token = TEST_BEARER_TOKEN
-    username = get_current_user(token)
+    username = asyncio.run(get_current_user(token))
     print(username)
@@ -0,0 +1,66 @@
+# bloom_filter.py
+
+from math import ceil, log
+from typing import Union
+import hashlib
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        assert capacity > 0
+        assert 0 < error_rate < 1
+        self.capacity = capacity
+        self.size = ceil(-capacity * log(error_rate) / log(2) ** 2)  # bits
+        self.hash_count = max(1, round(self.size / capacity * log(2)))
+        self.bits = bytearray(ceil(self.size / 8))
+        self.count = 0
+
+    def _indexes(self, key: bytes):
+        # double hashing: k indexes from the two halves of one digest
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key: bytes):
+        for index in self._indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, key: bytes):
+        return all(
+            self.bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(key)
+        )
+
+
+class RotatingBloomFilter:
+    """
+    Two generations of Bloom filters with a fixed memory budget.
+    Once the current generation is full it replaces the previous one,
+    so the oldest keys are forgotten first.
+    """
+
+    def __init__(self, capacity: int = 5000, error_rate: float = 0.01):
+        self.capacity = capacity
+        # a lookup checks both generations, so each gets half the error budget
+        self.error_rate = error_rate / 2
+        self.current = BloomFilter(capacity, self.error_rate)
+        self.previous = None
+
+    def _encode(self, key: Union[bytes, str]) -> bytes:
+        return key.encode() if isinstance(key, str) else key
+
+    def add(self, key: Union[bytes, str]):
+        key = self._encode(key)
+        if key in self.current:
+            return
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+        self.current.add(key)
+
+    def __contains__(self, key: Union[bytes, str]):
+        key = self._encode(key)
+        return key in self.current or (
+            self.previous is not None and key in self.previous
+        )
@@ -2,6 +2,11 @@
 Single factory across the app
 """
 
+import asyncio
+from random import sample
+import logging
+import os
+
 from .feed import Feed
 from .reddit import RedditFeed
 from .arxiv import ArxivFeed
@@ -9,9 +14,15 @@ from .youtube import YoutubeFeed
 from .openweathermap import OpenWeatherMapFeed
 from .lihkg import LihkgFeed
 
+logger = logging.getLogger(__name__)
+
 
 class FeedFactory:
     _instance = None
+    # upstream fetches running at once across all readers
+    MAX_CONCURRENCY = int(os.environ.get("DAILYPROPHET_MAX_FETCH_CONCURRENCY", 32))
+    # seconds before a shared upstream fetch is cancelled, freeing its slot and key
+    FETCH_TIMEOUT = 30.0
 
     FEED_CLASS_MAPS = {
         "reddit": RedditFeed,
@@ -25,6 +36,10 @@ class FeedFactory:
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             cls._instance._feeds = {}
+            cls._instance._in_flight = {}
+            cls._instance._fetch_semaphore = asyncio.Semaphore(
+                FeedFactory.MAX_CONCURRENCY
+            )
         return cls._instance
 
     def __getitem__(self, key):
@@ -35,6 +50,49 @@ class FeedFactory:
             self._feeds[key] = feed
             return feed
 
+    async def async_fetch(self, key: str, n: int):
+        """
+        Coalesce concurrent fetches of the same key into a single upstream fetch.
+        Callers joining an in-flight fetch draw their own sample from its result.
+        """
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None and n <= in_flight[1]:
+            logger.debug(f"Joining in-flight fetch for {key}")
+            task = in_flight[0]
+        else:
+            # a larger request cannot be served by the in-flight fetch
+            feed = self[key]
+            task = asyncio.ensure_future(self._async_bounded_fetch(key, feed, n))
+            self._in_flight[key] = (task, n)
+            task.add_done_callback(lambda t: self._release_in_flight(key, t))
+
+        # shield so that a cancelled caller does not cancel the shared fetch
+        feeds = await asyncio.shield(task)
+        if feeds is None:
+            return []
+        elif n < len(feeds):
+            return sample(feeds, n)
+        else:
+            return list(feeds)
+
+    async def _async_bounded_fetch(self, key: str, feed: Feed, n: int):
+        async with self._fetch_semaphore:
+            # callers only cancel their shielded waiters, so bound the fetch itself
+            try:
+                return await asyncio.wait_for(
+                    feed.async_fetch(n), FeedFactory.FETCH_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Cancelled fetch for {key} after {FeedFactory.FETCH_TIMEOUT}s"
+                )
+                raise
+
+    def _release_in_flight(self, key: str, task: asyncio.Future):
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None and in_flight[0] is task:
+            del self._in_flight[key]
+
     def create_feed(self, key: str):
         map = FeedFactory.FEED_CLASS_MAPS
         source, name = key.split("/")
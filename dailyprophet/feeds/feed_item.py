@@ -0,0 +1,109 @@
+# feed_item.py
+
+from typing import Collection, Optional
+
+import orjson
+
+
+class FeedItem:
+    """
+    Compact representation of a queued feed.
+    Fields common to all sources are slots; the rest are kept as a JSON blob
+    and only decoded when the item is rendered.
+    """
+
+    __slots__ = ("fingerprint", "timestamp", "source", "id", "title", "url", "extras")
+
+    timestamp_key = "timestamp"
+    common_keys = ("source", "id", "title", "url")
+    ignored_keys = ("_id", timestamp_key)
+    card_keys = {  # per-source summary fields on top of the common ones
+        "reddit": ("subreddit", "author", "ups", "num_comments", "created_utc"),
+        "youtube": ("channel", "publishTime"),
+        "arxiv": ("author", "published"),
+        "lihkg": ("like_count", "dislike_count", "no_of_reply", "create_time"),
+        "openweathermap": (
+            "city_name",
+            "city_country",
+            "list_0_dt",
+            "list_0_temp_min",
+            "list_0_temp_max",
+            "list_0_weather_0_description",
+        ),
+    }
+
+    def __init__(
+        self,
+        fingerprint: bytes,
+        timestamp: float,
+        source: Optional[str] = None,
+        id: Optional[str] = None,
+        title: Optional[str] = None,
+        url: Optional[str] = None,
+        extras: Optional[bytes] = None,
+    ):
+        self.fingerprint = fingerprint
+        self.timestamp = timestamp
+        self.source = source
+        self.id = id
+        self.title = title
+        self.url = url
+        self.extras = extras
+
+    @classmethod
+    def from_feed(cls, fingerprint: bytes, timestamp: float, feed: dict):
+        common = {}
+        extras = {}
+        for key, value in feed.items():
+            if key in FeedItem.ignored_keys:
+                continue
+            elif key in FeedItem.common_keys and value is not None:
+                common[key] = value
+            else:
+                extras[key] = value
+
+        blob = orjson.dumps(extras, default=str) if extras else None
+        return cls(fingerprint, timestamp, extras=blob, **common)
+
+    def get_extras(self) -> dict:
+        return orjson.loads(self.extras) if self.extras is not None else {}
+
+    def to_dict(self, fields: Optional[Collection[str]] = None) -> dict:
+        """
+        Render the feed, optionally projected to the given fields.
+        The extras blob is only decoded when a requested field lives there.
+        """
+        if fields is None:
+            feed = {FeedItem.timestamp_key: self.timestamp}
+            for key in FeedItem.common_keys:
+                value = getattr(self, key)
+                if value is not None:
+                    feed[key] = value
+            feed.update(self.get_extras())
+            return feed
+
+        feed = {}
+        extra_fields = []
+        for field in fields:
+            if field == FeedItem.timestamp_key:
+                feed[field] = self.timestamp
+            elif field in FeedItem.common_keys and getattr(self, field) is not None:
+                feed[field] = getattr(self, field)
+            else:
+                extra_fields.append(field)
+        if extra_fields and self.extras is not None:
+            extras = self.get_extras()
+            for field in extra_fields:
+                if field in extras:
+                    feed[field] = extras[field]
+        return feed
+
+    def to_card(self) -> dict:
+        """
+        Render the compact per-source summary shown on a feed card
+        """
+        card_keys = FeedItem.card_keys.get(self.source, ())
+        return self.to_dict(FeedItem.common_keys + card_keys)
+
+    def __repr__(self):
+        return f"FeedItem(source={self.source!r}, id={self.id!r}, url={self.url!r})"
@@ -1,85 +1,439 @@
 # feed_queue.py
 
 from collections import deque
-from datetime import datetime
-from typing import List
+from datetime import datetime, timedelta
+from heapq import heapify, heappop, heappush, nsmallest
+import itertools
+from math import log1p
+from typing import List, Optional
+import hashlib
+import json
 import logging
+import os
 
-from ..util import flatten_dict
+from .bloom_filter import RotatingBloomFilter
+from .feed_item import FeedItem
 
 logger = logging.getLogger(__name__)
 
 
 class FeedQueue:
-    timestamp_key = "timestamp"
+    timestamp_key = FeedItem.timestamp_key
+    identity_keys = ("id", "url")  # per-source identity, in order of preference
+    ignored_keys = FeedItem.ignored_keys  # not part of a feed's content
+    log_compact_min_records = 1000
+    log_compact_ratio = 4  # compact once the log is this many times the queue size
 
-    def __init__(self):
-        self.q = deque()
-        self.set = set()
+    def __init__(
+        self,
+        seen_filter: Optional[RotatingBloomFilter] = None,
+        max_size: Optional[int] = None,
+        max_age: Optional[timedelta] = None,
+        log_path: Optional[str] = None,
+    ):
+        self.q = deque()  # FeedItem, oldest first
+        self.set = set()  # fingerprints
+        self.seen_filter = seen_filter  # fingerprints already served
+        self.max_size = max_size
+        self.max_age = max_age
+        self.log_path = log_path  # append-only log of pushes and pops, if persistent
+        self.log_records = 0
 
     def size(self):
         return len(self.q)
 
     def push(self, feeds: List[dict]):
         current_timestamp = datetime.utcnow().timestamp()
+        pushed = []
         for feed in feeds:
-            feed_with_timestamp = {FeedQueue.timestamp_key: current_timestamp, **feed}
-
-            # Ignore timestamp when checking for uniqueness
-            hashable_feed = self.create_hashable_feed(feed)
-            if hashable_feed not in self.set:
-                self.q.append(feed_with_timestamp)
-                self.set.add(hashable_feed)
+            fingerprint = self.create_fingerprint(feed)
+            if self.seen_filter is not None and fingerprint in self.seen_filter:
+                logger.debug("Already served. Skip adding to the queue.")
+            elif fingerprint not in self.set:
+                item = FeedItem.from_feed(fingerprint, current_timestamp, feed)
+                self._append(item, feed)
+                self.set.add(fingerprint)
+                pushed.append(item)
             else:
                 logger.info("Duplicate. Skip adding to the queue.")
+        self._log_push(pushed)
 
-    def pop(self):
+        if self.max_size is not None and self.size() > self.max_size:
+            count = self._evict(self.size() - self.max_size)
+            logger.info(f"Queue full. Evicted {count} items.")
+
+    def _append(self, item: FeedItem, feed: dict):
+        self.q.append(item)
+
+    def _evict(self, n: int):
+        evicted = []
+        for _ in range(n):
+            item = self.q.popleft()  # oldest first
+            self.set.remove(item.fingerprint)
+            evicted.append(item.fingerprint)
+        self._log_pop(evicted)
+        return n
+
+    def pop(self) -> Optional[FeedItem]:
+        self.sweep()
         if self.q:
-            feed = self.q.popleft()
-            hashable_feed = self.create_hashable_feed(feed)
-            self.set.remove(hashable_feed)
-            return feed
+            item = self.q.popleft()
+            self.set.remove(item.fingerprint)
+            self.mark_seen(item.fingerprint)
+            self._log_pop([item.fingerprint])
+            return item
         else:
             return None
 
+    def pop_many(self, n: int) -> List[FeedItem]:
+        self.sweep()
+        count = min(max(n, 0), len(self.q))
+        popped = [self.q.popleft() for _ in range(count)]
+        fingerprints = [item.fingerprint for item in popped]
+        self.set.difference_update(fingerprints)
+        for fingerprint in fingerprints:
+            self.mark_seen(fingerprint)
+        self._log_pop(fingerprints)
+        return popped
+
+    def mark_seen(self, fingerprint: bytes):
+        if self.seen_filter is not None:
+            self.seen_filter.add(fingerprint)
+
+    def sweep(self):
+        """
+        Drop items older than max_age. The queue is in push order, so expired
+        items are always at the front.
+        """
+        cutoff = self._expiry_cutoff()
+        if cutoff is None:
+            return 0
+
+        expired = []
+        while self.q and self.q[0].timestamp < cutoff:
+            item = self.q.popleft()
+            self.set.remove(item.fingerprint)
+            expired.append(item.fingerprint)
+        self._log_pop(expired)
+        count = len(expired)
+        if count:
+            logger.info(f"Dropped {count} expired items in queue.")
+        return count
+
+    def _expiry_cutoff(self):
+        if self.max_age is None:
+            return None
+        return (datetime.utcnow() - self.max_age).timestamp()
+
     def clear(self):
         self.q.clear()
         self.set.clear()
+        self._write_log([{"op": "clear"}])
         logger.info("Queue cleared.")
 
     def trim_last(self, n: int):
-        count = 0
+        trimmed = []
         for _ in range(n):
             try:
-                feed = self.q.pop()
-                hashable_feed = self.create_hashable_feed(feed)
-                self.set.remove(hashable_feed)
-                count += 1
+                item = self.q.pop()
+                self.set.remove(item.fingerprint)
+                trimmed.append(item.fingerprint)
             except IndexError:
                 break
+        self._log_pop(trimmed)
+        count = len(trimmed)
         logger.info(f"Trimmed {count} items in queue.")
         return count
 
     def trim_last_until(self, n: int):
-        count = 0
+        trimmed = []
         while self.size() > n:
-            feed = self.q.pop()
-            hashable_feed = self.create_hashable_feed(feed)
-            self.set.remove(hashable_feed)
-            count += 1
+            item = self.q.pop()
+            self.set.remove(item.fingerprint)
+            trimmed.append(item.fingerprint)
+        self._log_pop(trimmed)
+        count = len(trimmed)
         remaining = self.size()
         logger.info(f"Trimmed {count} items in queue. Remaining {remaining} items.")
         return count
 
-    def create_hashable_feed(self, feed):
+    def items(self):
+        return iter(self.q)
+
+    def _log_push(self, pushed: List[FeedItem]):
+        if self.log_path is None:
+            return  # skip encoding the feeds when not persistent
+        self._write_log(
+            [
+                {"op": "push", "fp": item.fingerprint.hex(), "feed": item.to_dict()}
+                for item in pushed
+            ]
+        )
+
+    def _log_pop(self, fingerprints: List[bytes]):
+        if self.log_path is not None and fingerprints:
+            self._write_log([{"op": "pop", "fp": [fp.hex() for fp in fingerprints]}])
+
+    def _write_log(self, records: List[dict]):
+        if self.log_path is None or not records:
+            return
+
+        data = "".join(
+            json.dumps(record, separators=(",", ":"), default=str) + "\n"
+            for record in records
+        )
+        # opened per batch so that idle readers do not hold file descriptors
+        try:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(data)
+        except OSError as e:
+            # the queue in memory stays usable, only persistence is degraded
+            logger.error(f"Failed to write queue log {self.log_path}: {e}")
+            return
+        self.log_records += len(records)
+
+        threshold = max(
+            FeedQueue.log_compact_min_records, FeedQueue.log_compact_ratio * self.size()
+        )
+        if self.log_records > threshold:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the log with one push record per queued feed
+        """
+        if self.log_path is None:
+            return
+
+        tmp_path = f"{self.log_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for item in self.items():
+                    record = {
+                        "op": "push",
+                        "fp": item.fingerprint.hex(),
+                        "feed": item.to_dict(),
+                    }
+                    f.write(
+                        json.dumps(record, separators=(",", ":"), default=str) + "\n"
+                    )
+            os.replace(tmp_path, self.log_path)
+        except OSError as e:
+            logger.error(f"Failed to compact queue log {self.log_path}: {e}")
+            return
+        self.log_records = self.size()
+        logger.debug(f"Compacted queue log {self.log_path}")
+
+    def load(self):
+        """
+        Rehydrate the queue by replaying its log
+        """
+        if self.log_path is None or not os.path.exists(self.log_path):
+            return 0
+
+        feeds = {}
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skip corrupted record in {self.log_path}")
+                    continue
+                op = record.get("op")
+                if op == "push":
+                    feeds[record["fp"]] = record["feed"]
+                elif op == "pop":
+                    for fp in record["fp"]:
+                        feeds.pop(fp, None)
+                elif op == "clear":
+                    feeds.clear()
+
+        for fp, feed in feeds.items():
+            fingerprint = bytes.fromhex(fp)
+            if fingerprint not in self.set:
+                timestamp = feed[FeedQueue.timestamp_key]
+                self._append(FeedItem.from_feed(fingerprint, timestamp, feed), feed)
+                self.set.add(fingerprint)
+        self.compact()
+        self.sweep()
+        logger.info(f"Loaded {self.size()} items from {self.log_path}")
+        return self.size()
+
+    def close(self):
+        """
+        No file is held open between writes; kept for callers releasing a queue
+        """
+
+    def create_fingerprint(self, feed: dict) -> bytes:
         """
-        Ignore timestamp when removing from the set
+        Identify a feed by its source and id or url, falling back to a hash of its
+        content. Timestamp and Mongo _id are ignored.
         """
-        if "_id" in feed:
-            feed.pop("_id")
-        flattened_feed = flatten_dict(feed)
-        return tuple(
-            (key, value)
-            for key, value in flattened_feed.items()
-            if key != FeedQueue.timestamp_key
+        source = feed.get("source", "")
+        for key in FeedQueue.identity_keys:
+            value = feed.get(key)
+            if value:
+                identity = f"{source}:{key}:{value}"
+                break
+        else:
+            content = {k: v for k, v in feed.items() if k not in FeedQueue.ignored_keys}
+            identity = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.blake2b(identity.encode(), digest_size=16).digest()
+
+
+class PriorityFeedQueue(FeedQueue):
+    """
+    Feed queue that pops the best scored feed first, backed by a heap.
+    The score is computed once at push time: a normalized per-source engagement
+    plus a recency that decays from 1 to 0 over a per-source horizon, measured
+    from the push time. Both range over [0, 1].
+    """
+
+    NEUTRAL_ENGAGEMENT = 0.5  # for sources without engagement metrics
+    NEUTRAL_RECENCY = 0.5  # for feeds without a publish time
+    DEFAULT_RECENCY_HORIZON = 2 * 24 * 3600
+    RECENCY_HORIZONS = {  # age in seconds at which recency reaches 0, per source
+        "reddit": 24 * 3600,
+        "lihkg": 24 * 3600,
+        "youtube": 7 * 24 * 3600,
+        "arxiv": 7 * 24 * 3600,
+    }
+    ENGAGEMENT_SCALES = {  # engagement that scores 1.0, per source
+        "reddit": 5000,
+        "lihkg": 1000,
+    }
+
+    def __init__(
+        self,
+        seen_filter: Optional[RotatingBloomFilter] = None,
+        max_size: Optional[int] = None,
+        max_age: Optional[timedelta] = None,
+        log_path: Optional[str] = None,
+    ):
+        super().__init__(
+            seen_filter=seen_filter,
+            max_size=max_size,
+            max_age=max_age,
+            log_path=log_path,
         )
+        self.q = []  # heap of (-score, seq, FeedItem)
+        # tie breaker, keeps push order among equal scores
+        self.counter = itertools.count()
+
+    def _append(self, item: FeedItem, feed: dict):
+        entry = (-self.score(item, feed), next(self.counter), item)
+        heappush(self.q, entry)
+
+    def _evict(self, n: int):
+        # keep the best scored feeds
+        kept = nsmallest(len(self.q) - n, self.q)
+        self._replace(kept)
+        return n
+
+    def _replace(self, entries: List[tuple]):
+        heapify(entries)
+        kept = {item.fingerprint for _, _, item in entries}
+        removed = self.set - kept
+        self.q = entries
+        self.set = kept
+        self._log_pop(list(removed))
+
+    def pop(self):
+        popped = self.pop_many(1)
+        return popped[0] if popped else None
+
+    def pop_many(self, n: int):
+        cutoff = self._expiry_cutoff()
+        popped = []
+        removed = []
+        while self.q and len(popped) < n:
+            _, _, item = heappop(self.q)
+            self.set.remove(item.fingerprint)
+            removed.append(item.fingerprint)
+            if cutoff is not None and item.timestamp < cutoff:
+                continue  # expired, dropped lazily
+            self.mark_seen(item.fingerprint)
+            popped.append(item)
+        self._log_pop(removed)
+        return popped
+
+    def sweep(self):
+        cutoff = self._expiry_cutoff()
+        if cutoff is None:
+            return 0
+
+        kept = [entry for entry in self.q if entry[2].timestamp >= cutoff]
+        count = len(self.q) - len(kept)
+        if count:
+            self._replace(kept)
+            logger.info(f"Dropped {count} expired items in queue.")
+        return count
+
+    def items(self):
+        return (item for _, _, item in self.q)
+
+    def trim_last(self, n: int):
+        count = min(max(n, 0), self.size())
+        self._evict(count)
+        logger.info(f"Trimmed {count} items in queue.")
+        return count
+
+    def trim_last_until(self, n: int):
+        count = max(self.size() - n, 0)
+        self._evict(count)
+        remaining = self.size()
+        logger.info(f"Trimmed {count} items in queue. Remaining {remaining} items.")
+        return count
+
+    def score(self, item: FeedItem, feed: dict) -> float:
+        source = item.source
+        scale = PriorityFeedQueue.ENGAGEMENT_SCALES.get(source)
+        if scale is None:
+            engagement = PriorityFeedQueue.NEUTRAL_ENGAGEMENT
+        else:
+            engagement = min(log1p(max(self.engagement(feed), 0)) / log1p(scale), 1.0)
+        return engagement + self.recency(item, feed)
+
+    def recency(self, item: FeedItem, feed: dict) -> float:
+        published = self.published_timestamp(feed)
+        if published is None:
+            return PriorityFeedQueue.NEUTRAL_RECENCY
+
+        horizon = PriorityFeedQueue.RECENCY_HORIZONS.get(
+            item.source, PriorityFeedQueue.DEFAULT_RECENCY_HORIZON
+        )
+        age = max(item.timestamp - published, 0)  # relative to the push time
+        return 1.0 - min(age / horizon, 1.0)
+
+    def engagement(self, feed: dict) -> float:
+        source = feed.get("source")
+        if source == "reddit":
+            return (
+                feed.get("ups", 0)
+                + feed.get("downs", 0)
+                + feed.get("num_comments", 0) * 2
+            )
+        elif source == "lihkg":
+            return (
+                feed.get("like_count", 0)
+                + feed.get("dislike_count", 0)
+                + feed.get("reply_like_count", 0) * 2
+            )
+        return 0
+
+    def published_timestamp(self, feed: dict) -> Optional[float]:
+        """
+        Publish time in epoch seconds, None if unknown
+        """
+        for key in ("created_utc", "create_time"):  # reddit, lihkg
+            value = feed.get(key)
+            if isinstance(value, (int, float)):
+                return float(value)
+        for key in ("publishTime", "published"):  # youtube, arxiv
+            value = feed.get(key)
+            if value:
+                try:
+                    return datetime.fromisoformat(value).timestamp()
+                except (TypeError, ValueError):
+                    pass
+        return None
@@ -2,10 +2,13 @@
 
 import os
 import json
+from random import choices
 
-from typing import List, Optional
+from typing import Iterable, List, Optional
 import logging
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,6 +23,7 @@ class FeedPortfolio:
     def __init__(self, name: str, setting: Optional[List] = None) -> None:
         self.name = name
         self._portfolio = {}
+        self._sampler = None  # (keys, prob, alias), rebuilt lazily after changes
 
         if setting is not None:
             logger.debug(f"Portfolio setting provided by {name}.")
@@ -29,6 +33,7 @@ class FeedPortfolio:
                 f"No portfolio setting provided by {name}. Loading from default."
             )
             self.load_default()
+        self.dirty = False  # changed since last persisted
 
     def _format_setting_file_path(self, name, version: int = 0):
         assert version is not None
@@ -40,6 +45,8 @@ class FeedPortfolio:
 
     def _load_setting_from_file(self, name, verison: int = 1):
         self._portfolio = {}
+        self._sampler = None
+        self.dirty = True
         with open(self._format_setting_file_path(name, version=verison), "r") as f:
             setting = json.load(f)
             self.add_setting(setting)
@@ -54,9 +61,13 @@ class FeedPortfolio:
     def add(self, feed_type: str, name: str, weight: float):
         key = f"{feed_type}/{name}"
         self._portfolio[key] = float(weight)
+        self._sampler = None
+        self.dirty = True
 
     def load_setting(self, setting: List):
         self._portfolio = {}
+        self._sampler = None
+        self.dirty = True
         for feed_type, name, weight in setting:
             self.add(feed_type, name, weight)
 
@@ -71,3 +82,62 @@ class FeedPortfolio:
     def generate_key_weight(self):
         for key, weight in self._portfolio.items():
             yield key, weight
+
+    def __len__(self):
+        return len(self._portfolio)
+
+    def _build_sampler(self):
+        """
+        Build a Walker alias table so that each key draw costs O(1)
+        """
+        keys = [key for key, weight in self._portfolio.items() if weight > 0]
+        weights = np.array([self._portfolio[key] for key in keys], dtype=float)
+        size = len(keys)
+        if size == 0:
+            return [], np.empty(0), np.empty(0, dtype=int)
+
+        scaled = weights * size / weights.sum()
+        prob = np.ones(size)
+        alias = np.arange(size)
+        small = [i for i in range(size) if scaled[i] < 1.0]
+        large = [i for i in range(size) if scaled[i] >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # leftovers are 1.0 up to floating point error and keep prob 1.0
+
+        return np.array(keys, dtype=object), prob, alias
+
+    def sample_keys(self, n: int, exclude: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Draw n keys with replacement, proportional to their weights.
+        Excluded keys fall back to a one-off weighted draw over the rest.
+        """
+        if exclude:
+            exclude = set(exclude)
+            key_weights = [
+                (key, weight)
+                for key, weight in self._portfolio.items()
+                if weight > 0 and key not in exclude
+            ]
+            if n <= 0 or not key_weights:
+                return []
+            keys, weights = zip(*key_weights)
+            return choices(keys, weights=weights, k=n)
+
+        if self._sampler is None:
+            self._sampler = self._build_sampler()
+        keys, prob, alias = self._sampler
+        if n <= 0 or len(keys) == 0:
+            return []
+
+        columns = np.random.randint(len(keys), size=n)
+        coins = np.random.random(n)
+        picked = np.where(coins < prob[columns], columns, alias[columns])
+        return keys[picked].tolist()
@@ -3,7 +3,9 @@ import logging
 import asyncio
 from datetime import datetime
 from math import ceil
-import re
+from typing import Optional
+
+from cachetools import TLRUCache
 
 from .feed import Feed
 from ..util import expo_decay_weighted_sample, async_worker_fetch
@@ -15,53 +17,102 @@ logger = logging.getLogger(__name__)
 db = MongoDBService("feeds")
 
 
+def utc_timestamp():
+    return datetime.utcnow().timestamp()  # same clock as expire_time queries
+
+
+# ranked candidates by (source, subject_key), shared by all RedditFeed instances;
+# values are (expires_at, limit, posts)
+candidate_cache = TLRUCache(
+    maxsize=1024, ttu=lambda key, value, now: value[0], timer=utc_timestamp
+)
+
+
 class RedditFeed(Feed):
+    # dropped before posts leave the DB; _is_valid and expire_time are popped
+    # after caching
+    STORAGE_FIELDS = ("_id", "_score", "subject_key")
+    CANDIDATE_LIMIT = 90  # ranked posts cached per subject
+    CACHE_MAX_TTL = 300  # seconds candidates are served from memory at most
+
     def __init__(self, subject: str):
         super().__init__()
         self.source = "reddit"
         self.subject = subject
+        self.subject_key = subject.lower().strip()  # indexed, matched exactly
         self.fetch_lock = asyncio.Lock()  # Lock to control concurrent fetches
 
-    async def _check_valid_cache(self):
+    def cache_criteria(self, expire_time: Optional[dict] = None):
+        criteria = {"source": "reddit", "subject_key": self.subject_key}
+        if expire_time is not None:
+            criteria["expire_time"] = expire_time
+        return criteria
+
+    def cache_pipeline(self, now: int, n: int):
+        """
+        Rank cached posts server-side: valid posts first, then expired ones, each
+        by engagement. Only the top n are returned, without storage fields.
+        """
+        return [
+            {"$match": self.cache_criteria()},
+            {
+                "$addFields": {
+                    "_is_valid": {"$gte": ["$expire_time", now]},
+                    "_score": {
+                        "$add": [
+                            {"$ifNull": ["$ups", 0]},
+                            {"$ifNull": ["$downs", 0]},
+                            {"$multiply": [{"$ifNull": ["$num_comments", 0]}, 2]},
+                        ]
+                    },
+                }
+            },
+            {"$sort": {"_is_valid": -1, "_score": -1}},
+            {"$limit": n},
+            {"$project": {field: 0 for field in RedditFeed.STORAGE_FIELDS}},
+        ]
+
+    async def _check_cache(self, n: int):
         """
-        Check if the cache is still valid and return the cached result if possible.
-        If the cache is not enough, initiate background fetching to fill the gap.
+        Return the best n cached posts and how many of them are still valid.
+        The ranked candidates are kept in memory until the first valid one expires.
         """
-        logger.debug("Checking cache")
-        subject_re = re.compile(self.subject.lower().strip(), re.I)
-        criteria = {
-            "source": "reddit",
-            "subject": subject_re,
-            "expire_time": {"$gte": int(datetime.utcnow().timestamp())},
-        }
-        valid_cache = db.query(criteria)
-        return valid_cache
-
-    async def _check_expired_cache(self):
-        logger.debug("Querying expired cache")
-        subject_re = re.compile(self.subject.lower().strip(), re.I)
-        criteria = {
-            "source": "reddit",
-            "subject": subject_re,
-            "expire_time": {"$lt": int(datetime.utcnow().timestamp())},
-        }
-        expired_cache = db.query(criteria, size=50)  # avoid too many
-        return expired_cache
+        cache_key = (self.source, self.subject_key)
+        cached = candidate_cache.get(cache_key)
+        if cached is not None and (cached[1] >= n or len(cached[2]) < cached[1]):
+            logger.debug("Candidate cache hit")
+            candidates = cached[2]
+        else:
+            logger.debug("Checking cache")
+            now = utc_timestamp()
+            limit = max(n, RedditFeed.CANDIDATE_LIMIT)
+            candidates = await db.async_aggregate(self.cache_pipeline(int(now), limit))
+
+            expires_at = now + RedditFeed.CACHE_MAX_TTL
+            for post in candidates:
+                if post["_is_valid"]:
+                    expires_at = min(expires_at, post["expire_time"])
+            candidate_cache[cache_key] = (expires_at, limit, candidates)
+
+        cache = []
+        valid_count = 0
+        for post in candidates[:n]:
+            post = dict(post)  # cached posts are shared
+            post.pop("expire_time", None)  # not every cached post has one
+            valid_count += post.pop("_is_valid")
+            cache.append(post)
+        return cache, valid_count
+
+    def invalidate_cache(self):
+        candidate_cache.pop((self.source, self.subject_key), None)
 
     async def async_fetch(self, n: int):
         try:
-            valid_cache = await self._check_valid_cache()
-            expired_cache = await self._check_expired_cache()
-
-            sort_key = lambda x: x["ups"] + x["downs"] + x["num_comments"] * 2
-            valid_cache.sort(key=sort_key, reverse=True)
-            expired_cache.sort(key=sort_key, reverse=True)
-            combined_cache = valid_cache + expired_cache
-            combined_cache = combined_cache[:n]
+            combined_cache, valid_count = await self._check_cache(n)
 
             # attempt to fill the cache if no other coroutine already does
             is_locked = self.fetch_lock.locked()
-            if n > len(valid_cache) and not is_locked:
+            if n > valid_count and not is_locked:
                 # Acquire the lock before scheduling the background task
                 logger.debug("Attempt to fill cache")
                 async with self.fetch_lock:
@@ -70,9 +121,8 @@ class RedditFeed(Feed):
                     target_cache_size = (
                         ceil(n / 30) * 30
                     )  # keep a cache with a size of multiple of 30
-                    asyncio.ensure_future(
-                        async_worker_fetch(self.source, self.subject, target_cache_size)
-                    )
+                    self.invalidate_cache()
+                    asyncio.ensure_future(self._async_fill_cache(target_cache_size))
                     await asyncio.sleep(1)  # keep the lock longer
 
             return expo_decay_weighted_sample(combined_cache, k=n)
@@ -80,6 +130,12 @@ class RedditFeed(Feed):
             logger.error(f"Error fetching Reddit posts asynchronously: {e}")
             return []
 
+    async def _async_fill_cache(self, n: int):
+        await async_worker_fetch(self.source, self.subject, n)
+        # the worker writes posts without a subject_key
+        await db.async_backfill_subject_keys(self.source, self.subject)
+        self.invalidate_cache()  # drop candidates cached while the worker ran
+
 
 async def test_async_fetch():
     import json
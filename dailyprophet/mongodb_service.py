@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
+import asyncio
 import logging
-from typing import Optional
+import re
 
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient, ReplaceOne
 
 from .configs import MONGODB_USER, MONGODB_PASSWORD, MONGODB_CLUSTER
 
@@ -9,11 +13,25 @@ logger = logging.getLogger(__name__)
 
 
 class MongoDBService:
+    IO_THREADS = 8  # threads running blocking pymongo calls for async callers
+    MAX_PENDING = 64  # async calls queued or running at once
+    INDEXES = {  # compound indexes by collection
+        "feeds": [
+            [
+                ("source", ASCENDING),
+                ("subject_key", ASCENDING),
+                ("expire_time", ASCENDING),
+            ]
+        ],
+    }
+
     def __init__(self, collection: str):
         self.uri = f"mongodb+srv://{MONGODB_USER}:{MONGODB_PASSWORD}@{MONGODB_CLUSTER}/?retryWrites=true&w=majority"
         self.client = MongoClient(self.uri)
         self.db_name = "dailyprophet"
         self.collection_name = collection
+        self._executor = None  # created on the first async call
+        self._pending = None
 
     def connect(self):
         try:
@@ -25,6 +43,9 @@ class MongoDBService:
 
     def disconnect(self):
         try:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
             self.client.close()
             logger.debug("Disconnected from the database")
         except Exception as e:
@@ -71,6 +92,24 @@ class MongoDBService:
 
         return result
 
+    def bulk_save(self, records: dict, key_field="_id"):
+        """
+        Upsert many records, keyed by their key field value, in one round trip
+        """
+        if not records:
+            return None
+
+        database = self.client[self.db_name]
+        collection = database[self.collection_name]
+
+        requests = [
+            ReplaceOne({key_field: key}, record, upsert=True)
+            for key, record in records.items()
+        ]
+        result = collection.bulk_write(requests, ordered=False)
+
+        return result
+
     def insert(self, record):
         database = self.client[self.db_name]
         collection = database[self.collection_name]
@@ -99,6 +138,77 @@ class MongoDBService:
         else:
             return list(collection.find(criteria))
 
+    def aggregate(self, pipeline: List[dict]):
+        database = self.client[self.db_name]
+        collection = database[self.collection_name]
+        return list(collection.aggregate(pipeline))
+
+    def ensure_indexes(self):
+        """
+        Create the indexes of this collection if missing; no-op when they exist
+        """
+        database = self.client[self.db_name]
+        collection = database[self.collection_name]
+
+        names = []
+        for keys in MongoDBService.INDEXES.get(self.collection_name, []):
+            names.append(collection.create_index(keys))
+        logger.debug(f"Indexes ensured on {self.collection_name}: {names}")
+        return names
+
+    def backfill_subject_keys(
+        self, source: Optional[str] = None, subject: Optional[str] = None
+    ):
+        """
+        Set the normalized subject_key on documents written without one.
+        Without a source and subject this scans the whole collection, so the app
+        runs it in the background after startup; refills scope it to the subject
+        they filled.
+        """
+        database = self.client[self.db_name]
+        collection = database[self.collection_name]
+
+        criteria = {"subject": {"$type": "string"}, "subject_key": {"$exists": False}}
+        if source is not None:
+            criteria["source"] = source
+        if subject is not None:
+            pattern = rf"^\s*{re.escape(subject.strip())}\s*$"
+            criteria["subject"] = {"$regex": pattern, "$options": "i"}
+
+        result = collection.update_many(
+            criteria,
+            [{"$set": {"subject_key": {"$toLower": {"$trim": {"input": "$subject"}}}}}],
+        )
+        logger.debug(f"Backfilled subject_key on {result.modified_count} document(s)")
+        return result.modified_count
+
+    async def _run_async(self, func, *args):
+        """
+        Run a blocking call on the I/O threads of this service.
+        Callers beyond MAX_PENDING wait here instead of piling up in the executor.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=MongoDBService.IO_THREADS,
+                thread_name_prefix=f"mongodb-{self.collection_name}",
+            )
+            self._pending = asyncio.Semaphore(MongoDBService.MAX_PENDING)
+
+        async with self._pending:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, partial(func, *args))
+
+    async def async_query(self, criteria: dict, size: Optional[int] = None):
+        return await self._run_async(self.query, criteria, size)
+
+    async def async_aggregate(self, pipeline: List[dict]):
+        return await self._run_async(self.aggregate, pipeline)
+
+    async def async_backfill_subject_keys(
+        self, source: Optional[str] = None, subject: Optional[str] = None
+    ):
+        return await self._run_async(self.backfill_subject_keys, source, subject)
+
 
 if __name__ == "__main__":
     # db = MongoDBService("readers")
@@ -132,7 +242,7 @@ if __name__ == "__main__":
     db = MongoDBService("feeds")
     criteria = {
         "source": "reddit",
-        "subject": "sex",
+        "subject_key": "sex",
         "expire_time": {"$gte": int(datetime.utcnow().timestamp())},
     }
     records = db.query(criteria)
@@ -1,21 +1,49 @@
 # readers/reader.py
 
-from random import choices, shuffle
+from random import shuffle
 from collections import Counter
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from math import ceil, exp
 from typing import List, Optional
+from urllib.parse import quote
 import logging
+import os
+import time
 
 from ..feeds.portfolio import FeedPortfolio
-from ..feeds.feed_queue import FeedQueue
+from ..feeds.feed_queue import FeedQueue, PriorityFeedQueue
+from ..feeds.bloom_filter import RotatingBloomFilter
 from ..feeds.feed_factory import FeedFactory
+from .refill_coordinator import RefillCoordinator
 
 logger = logging.getLogger(__name__)
 
 
 class Reader:
-    def __init__(self, name: str, record: Optional[dict] = None) -> None:
+    LATENCY_BUDGET = 3.0  # seconds to wait for feeds before returning partial results
+    STREAM_BUDGET = 10.0  # seconds a stream waits for fresh feeds
+    HARD_TIMEOUT = FeedFactory.FETCH_TIMEOUT  # seconds before stragglers are cancelled
+    MAX_REALLOCATION_ROUNDS = 2  # extra rounds to make up for under-delivering feeds
+    SEEN_CAPACITY = 5000  # served feeds remembered per filter generation
+    SEEN_ERROR_RATE = 0.01  # false positive rate of the served-feed filter
+    QUEUE_MAX_SIZE = 500
+    QUEUE_MAX_AGE = timedelta(hours=3)
+    PRIORITY_QUEUE = False  # pop the best scored feed first instead of in order
+    POP_RATE_TIME_CONSTANT = 5.0  # minutes, EWMA time constant of the pop rate
+    REFILL_LEAD_TIME = 5.0  # minutes of reading a refill should cover
+    LOW_WATER_LEAD_TIME = 1.0  # minutes of reading left when a refill starts
+    MIN_REFILL_SIZE = 20
+    MAX_REFILL_SIZE = 100
+    MIN_LOW_WATER_MARK = 5
+    MAX_LOW_WATER_MARK = 50
+
+    def __init__(
+        self,
+        name: str,
+        record: Optional[dict] = None,
+        queue_log_dir: Optional[str] = None,
+    ) -> None:
         self.name = name
 
         if record is not None:
@@ -24,59 +52,215 @@ class Reader:
             setting = None
         self.portfolio = FeedPortfolio(name, setting)
 
-        self.queue = FeedQueue()
+        if queue_log_dir is not None:
+            queue_log_path = os.path.join(queue_log_dir, f"{quote(name, safe='')}.log")
+        else:
+            queue_log_path = None
+        queue_class = PriorityFeedQueue if Reader.PRIORITY_QUEUE else FeedQueue
+        self.queue = queue_class(
+            seen_filter=RotatingBloomFilter(
+                capacity=Reader.SEEN_CAPACITY, error_rate=Reader.SEEN_ERROR_RATE
+            ),
+            max_size=Reader.QUEUE_MAX_SIZE,
+            max_age=Reader.QUEUE_MAX_AGE,
+            log_path=queue_log_path,
+        )
         self.factory = FeedFactory()
+        self._backfill_tasks = set()
+        self.refill_coordinator = RefillCoordinator(self)
+        self._pop_count = 0.0  # exponentially decayed number of pops
+        self._pop_count_time = time.monotonic()
 
     async def async_fetch_feed(self, key, count):
-        feed = self.factory[key]
-        return await feed.async_fetch(count)
-
-    async def async_sample(self, n: int):
-        if not self.portfolio:
+        # the factory caps concurrent upstream fetches across all readers
+        try:
+            return await self.factory.async_fetch(key, count)
+        except Exception as e:
+            logger.error(f"Error fetching {key}: {e}")
             return []
 
-        keys, weights = zip(
-            *[(key, weight) for key, weight in self.portfolio.generate_key_weight()]
-        )
-        sampled_keys = choices(keys, weights=weights, k=n)
-        sampled_feed_counts = dict(Counter(sampled_keys))
-        logger.debug(sampled_feed_counts)
-
-        async def fetch_sampled_feed(key, count):
-            return await self.async_fetch_feed(key, count)
-
+    async def async_sample(
+        self,
+        n: int,
+        budget: Optional[float] = None,
+        hard_timeout: float = HARD_TIMEOUT,
+    ):
         sampled_feeds = []
+        async for feeds in self.async_iter_sample(n, budget, hard_timeout):
+            sampled_feeds.extend(feeds)
 
-        def run(corofn, *args):
-            loop = asyncio.new_event_loop()
-            try:
-                coro = corofn(*args)
-                asyncio.set_event_loop(loop)
-                return loop.run_until_complete(coro)
-            finally:
-                loop.close()
-
-        with ThreadPoolExecutor() as executor:
-            loop = asyncio.get_event_loop()
-            tasks = [
-                loop.run_in_executor(executor, run, fetch_sampled_feed, key, count)
-                for key, count in sampled_feed_counts.items()
-            ]
-            sampled_feeds = await asyncio.gather(*tasks)
-
-        sampled_feeds = [
-            feed for sublist in sampled_feeds for feed in sublist
-        ]  # flattening
         shuffle(sampled_feeds)  # can be sorted by priority instead if available
 
         return sampled_feeds
 
+    async def async_iter_sample(
+        self,
+        n: int,
+        budget: Optional[float] = None,
+        hard_timeout: float = HARD_TIMEOUT,
+    ):
+        """
+        Sample n feeds across the portfolio, yielding them in batches as fetches complete.
+        Keys that under-deliver have their shortfall redrawn from the other keys.
+        With a latency budget (in seconds), only the feeds fetched in time are yielded.
+        Stragglers keep running in the background and are pushed to the queue when
+        they finish, or cancelled once the hard timeout has passed.
+        """
+        if not self.portfolio:
+            return
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + budget if budget is not None else None
+        hard_deadline = start + hard_timeout
+
+        tasks = {}  # task -> (key, count, reallocation attempt)
+        exhausted_keys = set()  # keys that under-delivered
+
+        def fetch_sampled_keys(count: int, attempt: int):
+            sampled_keys = self.portfolio.sample_keys(count, exclude=exhausted_keys)
+            sampled_feed_counts = dict(Counter(sampled_keys))
+            logger.debug(sampled_feed_counts)
+
+            # fan out on the running loop; the factory caps concurrent fetches
+            new_tasks = set()
+            for key, key_count in sampled_feed_counts.items():
+                task = asyncio.ensure_future(self.async_fetch_feed(key, key_count))
+                tasks[task] = (key, key_count, attempt)
+                new_tasks.add(task)
+            return new_tasks
+
+        pending = fetch_sampled_keys(n, 0)
+        try:
+            while pending:
+                timeout = None if deadline is None else max(deadline - loop.time(), 0)
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    break  # latency budget used up
+
+                batch = []
+                for task in done:
+                    key, count, attempt = tasks.pop(task)
+                    feeds = task.result()
+                    batch.extend(feeds)
+
+                    shortfall = count - len(feeds)
+                    if shortfall > 0:
+                        exhausted_keys.add(key)
+                        if attempt < Reader.MAX_REALLOCATION_ROUNDS:
+                            logger.debug(f"Reallocating {shortfall} feed(s) from {key}")
+                            pending |= fetch_sampled_keys(shortfall, attempt + 1)
+
+                if batch:
+                    yield batch
+        finally:
+            # also reached when the consumer stops early
+            if pending:
+                logger.debug(f"{len(pending)} feed fetch(es) exceeded the budget")
+                self._schedule_backfill(pending, max(hard_deadline - loop.time(), 0))
+
+    def _schedule_backfill(self, pending, timeout: float):
+        task = asyncio.ensure_future(self._async_backfill(pending, timeout))
+        self._backfill_tasks.add(task)  # keep a reference until done
+        task.add_done_callback(self._backfill_tasks.discard)
+
+    async def _async_backfill(self, pending, timeout: float):
+        try:
+            for next_done in asyncio.as_completed(pending, timeout=timeout):
+                feeds = await next_done
+                shuffle(feeds)
+                self.push_queue(feeds)
+        except asyncio.TimeoutError:
+            stragglers = [task for task in pending if not task.done()]
+            logger.warning(f"Cancelling {len(stragglers)} straggling feed fetch(es)")
+            for task in stragglers:
+                task.cancel()
+
     def push_queue(self, feeds: List):
         self.queue.push(feeds)
+        self.refill_coordinator.notify_pushed()  # wake pops waiting on a refill
+
+    async def async_new(self, n: int, budget: Optional[float] = None):
+        # push each batch as it arrives so that pops need not wait for the slowest
+        async for feeds in self.async_iter_sample(n, budget=budget):
+            shuffle(feeds)
+            self.push_queue(feeds)
+
+    async def async_stream(self, n: int, budget: Optional[float] = None):
+        """
+        Yield up to n feeds: queued feeds first, then fresh feeds as they are fetched
+        """
+        queued = self.queue.pop_many(n)
+        self.record_pops(len(queued))
+        for feed in queued:
+            yield feed
+
+        remaining = n - len(queued)
+        if remaining <= 0:
+            return
+
+        # fresh feeds go through the queue for dedup and served-feed tracking
+        async for feeds in self.async_iter_sample(remaining, budget=budget):
+            shuffle(feeds)
+            self.push_queue(feeds)
+            popped = self.queue.pop_many(min(len(feeds), remaining))
+            self.record_pops(len(popped))
+            for feed in popped:
+                yield feed
 
-    async def async_new(self, n: int):
-        feeds = await self.async_sample(n)
-        self.push_queue(feeds)
+            remaining -= len(popped)
+            if remaining <= 0:
+                break
 
     async def async_pop(self):
-        return self.queue.pop()
+        if self.queue.size() == 0:
+            await self.refill_coordinator.async_wait()
+        feed = self.queue.pop()
+        if feed is not None:
+            self.record_pops(1)
+        return feed
+
+    async def async_pop_many(self, n: int):
+        if self.queue.size() < n:
+            await self.refill_coordinator.async_wait(n)
+        feeds = self.queue.pop_many(n)
+        self.record_pops(len(feeds))
+        return feeds
+
+    def _decayed_pop_count(self, now: float):
+        elapsed = (now - self._pop_count_time) / 60
+        return self._pop_count * exp(-elapsed / Reader.POP_RATE_TIME_CONSTANT)
+
+    def record_pops(self, n: int):
+        now = time.monotonic()
+        self._pop_count = self._decayed_pop_count(now) + n
+        self._pop_count_time = now
+
+    def pop_rate(self):
+        """
+        Exponentially weighted moving average of pops per minute
+        """
+        now = time.monotonic()
+        return self._decayed_pop_count(now) / Reader.POP_RATE_TIME_CONSTANT
+
+    def refill_size(self):
+        size = ceil(self.pop_rate() * Reader.REFILL_LEAD_TIME)
+        return min(max(size, Reader.MIN_REFILL_SIZE), Reader.MAX_REFILL_SIZE)
+
+    def low_water_mark(self):
+        mark = ceil(self.pop_rate() * Reader.LOW_WATER_LEAD_TIME)
+        return min(max(mark, Reader.MIN_LOW_WATER_MARK), Reader.MAX_LOW_WATER_MARK)
+
+    def is_busy(self):
+        """
+        Whether a refill or backfill is still pushing to the queue
+        """
+        return self.refill_coordinator.is_refilling() or bool(self._backfill_tasks)
+
+    def refill(self):
+        """
+        Start a background refill unless one is already running
+        """
+        return self.refill_coordinator.maybe_refill()
@@ -1,7 +1,12 @@
 # readers/reader_manager.py
 
-from typing import List
+from collections import OrderedDict
+from typing import List, Optional
+import asyncio
 import logging
+import os
+import threading
+import time
 
 from .reader import Reader
 from ..mongodb_service import MongoDBService
@@ -10,74 +15,272 @@ logger = logging.getLogger(__name__)
 
 
 class ReaderManager:
+    """
+    Keeps the readers of active users in memory.
+    Readers are hydrated from the DB on first access, off the event loop with
+    async_get, and evicted, least recently used first, once idle or over capacity.
+    New and changed readers are written behind in batches by sync.
+    """
+
     DEFAULT_USER = "PUBLIC"
     KEY_FIELD = "userId"
+    # set to persist reader queues across restarts
+    QUEUE_LOG_DIR = os.environ.get("DAILYPROPHET_QUEUE_LOG_DIR")
+    MAX_READERS = 1000  # readers kept in memory
+    IDLE_TIMEOUT = 3600  # seconds without access before a reader is evicted
 
-    def __init__(self):
-        self._readers = {}
+    def __init__(
+        self,
+        queue_log_dir: Optional[str] = QUEUE_LOG_DIR,
+        max_readers: int = MAX_READERS,
+        idle_timeout: float = IDLE_TIMEOUT,
+    ):
+        self._readers = OrderedDict()  # least recently used first
+        self._last_access = {}
+        # guards _readers and _last_access, also reached by the sync __getitem__
+        self._lock = threading.Lock()
+        self._loading = {}  # id -> in-flight load task, on the event loop only
+        self._pending = {}  # records not yet acknowledged by the DB
+        self._pending_lock = threading.Lock()  # sync runs in a worker thread
+        self.queue_log_dir = queue_log_dir
+        if queue_log_dir is not None:
+            os.makedirs(queue_log_dir, exist_ok=True)
+        self.max_readers = max_readers
+        self.idle_timeout = idle_timeout
         self.db = MongoDBService("readers")
         self.load()
 
     def load(self):
-        key_field = ReaderManager.KEY_FIELD
+        """
+        Hydrate the default reader; the others are loaded on demand
+        """
         default_user = ReaderManager.DEFAULT_USER
+        if self._get_loaded(default_user) is None:
+            self._insert(default_user, self._load_reader(default_user))
+
+    def _new_reader(self, id: str, record: Optional[dict] = None):
+        return Reader(id, record=record, queue_log_dir=self.queue_log_dir)
+
+    def _load_reader(self, id: str):
+        key_field = ReaderManager.KEY_FIELD
+        with self._pending_lock:
+            pending_record = self._pending.get(id)
         try:
-            reader_records = self.db.read_all()
+            if pending_record is not None:
+                record = pending_record  # newer than the stored one
+            else:
+                record = self.db.read(id, key_field=key_field)
         except Exception as e:
             logger.error(e)
-            logger.error("Failed to load DB reader records!!!")
-            reader_records = [
-                {
-                    key_field: default_user,
-                }
-            ]
-
-        for record in reader_records:
-            reader_name = record[key_field]
-            if reader_name not in self._readers:
-                self._readers[reader_name] = Reader(reader_name, record=record)
+            logger.error(f"Failed to load DB reader record for {id}!!!")
+            # do not persist, the stored portfolio may still be there
+            reader = self._new_reader(id)
+        else:
+            if record:
+                logger.debug(f"Load reader {id}")
+                reader = self._new_reader(id, record)
+            else:
+                logger.debug(f"Create new reader {id}")
+                reader = self.create_reader(id)
+        reader.queue.load()
+        return reader
+
+    def _get_loaded(self, id: str):
+        with self._lock:
+            reader = self._readers.get(id)
+            if reader is not None:
+                logger.debug(f"Existing reader {id}")
+                self._readers.move_to_end(id)
+                self._last_access[id] = time.monotonic()
+            return reader
+
+    def _insert(self, id: str, reader: Reader):
+        with self._lock:
+            existing = self._readers.get(id)
+            if existing is not None:
+                reader = existing  # loaded meanwhile by another caller
+            else:
+                self._readers[id] = reader
+            self._readers.move_to_end(id)
+            self._last_access[id] = time.monotonic()
+            over_capacity = len(self._readers) > self.max_readers
+
+        if over_capacity:
+            self.evict()
+        return reader
 
     def __getitem__(self, id: str):
+        """
+        Get a reader, loading it in the calling thread if needed.
+        Handlers on the event loop use async_get instead.
+        """
         if id is None:
             logger.debug("Null reader Id. Use default reader.")
-            return self.get_default()
-        elif id in self._readers:
-            logger.debug(f"Existing reader {id}")
-            return self._readers[id]
-        else:
-            logger.debug(f"Create new reader {id}")
-            reader = self.create_reader(id)
+            id = ReaderManager.DEFAULT_USER
+
+        reader = self._get_loaded(id)
+        if reader is None:
+            reader = self._insert(id, self._load_reader(id))
+        return reader
+
+    async def async_get(self, id: str):
+        """
+        Get a reader, loading it in a worker thread if needed.
+        Concurrent first requests for the same id share one load.
+        """
+        if id is None:
+            logger.debug("Null reader Id. Use default reader.")
+            id = ReaderManager.DEFAULT_USER
+
+        reader = self._get_loaded(id)
+        if reader is not None:
             return reader
 
+        task = self._loading.get(id)
+        if task is None:
+            task = asyncio.ensure_future(self._async_load(id))
+            self._loading[id] = task
+            task.add_done_callback(lambda t: self._release_loading(id, t))
+        # shield so that a cancelled request does not cancel the shared load
+        return await asyncio.shield(task)
+
+    async def _async_load(self, id: str):
+        reader = await asyncio.to_thread(self._load_reader, id)
+        return self._insert(id, reader)
+
+    def _release_loading(self, id: str, task: asyncio.Future):
+        if self._loading.get(id) is task:
+            del self._loading[id]
+
     def get_default(self):
-        return self._readers[ReaderManager.DEFAULT_USER]
+        return self[ReaderManager.DEFAULT_USER]
 
     def create_reader(self, id: str):
-        key_field = ReaderManager.KEY_FIELD
-        new_reader = Reader(id, record=None)
-        self._readers[id] = new_reader  # in-memory
+        new_reader = self._new_reader(id)
+        new_reader.portfolio.dirty = True  # persisted by the next sync
+        return new_reader
 
-        portfolio = new_reader.portfolio.get_setting()
-        record = {key_field: id, "portfolio": portfolio}
+    def evict(self):
+        """
+        Drop readers idle past the timeout, then the least recently used ones while
+        over capacity. Readers still refilling are kept. Unsaved changes of evicted
+        readers are persisted by the next sync.
+        """
+        now = time.monotonic()
+        evicted_readers = []
+        with self._lock:
+            over_capacity = len(self._readers) - self.max_readers
+            evicted = []
+            for id, reader in self._readers.items():
+                if id == ReaderManager.DEFAULT_USER:
+                    continue
+                idle = now - self._last_access[id] > self.idle_timeout
+                if not idle and over_capacity <= 0:
+                    break  # the rest were used more recently
+                if reader.is_busy():
+                    continue
+                evicted.append(id)
+                over_capacity -= 1
 
-        self.db.save(id, record, key_field=key_field)  # persist
-        return new_reader
+            for id in evicted:
+                evicted_readers.append(self._readers.pop(id))
+                del self._last_access[id]
+
+        for reader in evicted_readers:
+            reader.queue.close()
+        self._defer(evicted_readers)
+        if evicted_readers:
+            logger.info(f"Evicted {len(evicted_readers)} reader(s).")
+        return len(evicted_readers)
+
+    def loaded_readers(self) -> List[Reader]:
+        with self._lock:
+            return list(self._readers.values())
+
+    def close(self):
+        for reader in self.loaded_readers():
+            reader.queue.close()
+
+    def sweep(self):
+        count = 0
+        for reader in self.loaded_readers():
+            count += reader.queue.sweep()
+        logger.info(f"Swept {count} expired items across readers.")
+        self.evict()
+        return count
+
+    def serialize(self, readers: Optional[List[Reader]] = None):
+        if readers is None:
+            readers = self.loaded_readers()
 
-    def serialize(self):
         reader_dict = {}
-        for name, reader in self._readers.items():
+        for reader in readers:
             portfolio = reader.portfolio.get_setting()
-            new_item = {"userId": name, "portfolio": portfolio}
-            reader_dict[name] = new_item
+            new_item = {"userId": reader.name, "portfolio": portfolio}
+            reader_dict[reader.name] = new_item
         return reader_dict
 
+    def _take_dirty(self, readers: List[Reader]):
+        # clear first so that changes made during the write are kept dirty
+        dirty_readers = [reader for reader in readers if reader.portfolio.dirty]
+        for reader in dirty_readers:
+            reader.portfolio.dirty = False
+        return self.serialize(dirty_readers)
+
+    def _defer(self, readers: List[Reader]):
+        """
+        Buffer the records of dirty readers for the next sync
+        """
+        records = self._take_dirty(readers)
+        with self._pending_lock:
+            self._pending.update(records)
+
+    def _collect(self):
+        """
+        Move the records of dirty readers to pending and snapshot them for a write.
+        Runs where portfolios are changed, on the event loop, so that serializing
+        does not race with handlers updating them.
+        """
+        records = self._take_dirty(self.loaded_readers())
+        with self._pending_lock:
+            # records in flight stay pending, and visible to loads, until written
+            self._pending.update(records)
+            return dict(self._pending)
+
+    def _write(self, records: dict):
+        if not records:
+            return 0
+
+        try:
+            self.db.bulk_save(records, key_field=ReaderManager.KEY_FIELD)
+        except Exception as e:
+            logger.error(f"Failed to persist {len(records)} reader(s): {e}")
+            return 0  # left pending for the next sync
+
+        with self._pending_lock:
+            for id, record in records.items():
+                if self._pending.get(id) is record:  # not replaced meanwhile
+                    del self._pending[id]
+
+        logger.info(f"Reader Manager sync done! {len(records)} reader(s) persisted.")
+        return len(records)
+
     def sync(self):
-        key_field = ReaderManager.KEY_FIELD
+        """
+        Persist readers changed since the last sync in a single bulk write.
+        Blocks on the DB; handlers on the event loop use async_sync instead.
+        """
+        return self._write(self._collect())
 
-        reader_dict = self.serialize()
-        for id, record in reader_dict.items():
-            self.db.save(id, record, key_field=key_field)  # persist
-        logger.info("Reader Manager sync done!")
+    async def async_sync(self):
+        """
+        Like sync, with only the bulk write run in a worker thread.
+        The app calls it periodically, which batches changes made in between.
+        """
+        records = self._collect()
+        if not records:
+            return 0
+        return await asyncio.to_thread(self._write, records)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+# readers/refill_coordinator.py
+
+from typing import Optional
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RefillCoordinator:
+    """
+    Runs at most one background refill per reader at a time.
+    The low-water mark and refill size are set by the reader from its pop rate.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.task = None
+        self._pushed = asyncio.Event()  # set by the reader when feeds are queued
+
+    def is_refilling(self):
+        return self.task is not None and not self.task.done()
+
+    def maybe_refill(self):
+        if self.is_refilling():
+            return False
+
+        if self.reader.queue.size() >= self.reader.low_water_mark():
+            return False
+
+        refill_size = self.reader.refill_size()
+        self.task = asyncio.ensure_future(self._async_refill(refill_size))
+        return True
+
+    async def _async_refill(self, refill_size: int):
+        try:
+            logger.debug(f"Refilling {refill_size} feeds for {self.reader.name}")
+            # stragglers are left to the backfill and its hard timeout, so a hung
+            # source cannot hold the refill slot
+            await self.reader.async_new(refill_size, budget=self.reader.LATENCY_BUDGET)
+        except Exception as e:
+            logger.error(f"Error refilling queue for {self.reader.name}: {e}")
+
+    def notify_pushed(self):
+        self._pushed.set()
+
+    async def async_wait(self, n: int = 1, timeout: Optional[float] = None):
+        """
+        Wait for an in-flight refill until the queue holds n feeds or the refill is
+        done. The timeout defaults to the latency budget the refill runs with.
+        """
+        if timeout is None:
+            timeout = self.reader.LATENCY_BUDGET
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while self.is_refilling() and self.reader.queue.size() < n:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._pushed.clear()
+            pushed = asyncio.ensure_future(self._pushed.wait())
+            try:
+                # asyncio.wait does not cancel the refill on timeout
+                await asyncio.wait(
+                    {self.task, pushed},
+                    timeout=remaining,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            finally:
+                pushed.cancel()
@@ -0,0 +1,165 @@
+import threading
+import unittest
+from unittest import mock
+
+from fastapi.responses import ORJSONResponse
+from fastapi.testclient import TestClient
+import orjson
+
+from dailyprophet.auth import get_current_user
+from dailyprophet.readers.reader_manager import ReaderManager
+from dailyprophet.tests.test_reader import FakeFactory
+from dailyprophet.tests.test_reader_manager import FakeDB
+
+with mock.patch("dailyprophet.readers.reader_manager.MongoDBService", FakeDB):
+    from dailyprophet import app as app_module
+
+
+class FakeFeedsDB:
+    """
+    Stands in for MongoDBService on the feeds collection at startup
+    """
+
+    gate = None  # a threading.Event holding the backfill
+    done = None  # a threading.Event set once the backfill ran
+    calls = []
+
+    def __init__(self, collection: str):
+        self.collection = collection
+
+    def ensure_indexes(self):
+        FakeFeedsDB.calls.append("ensure_indexes")
+
+    def backfill_subject_keys(self):
+        FakeFeedsDB.gate.wait(1)
+        FakeFeedsDB.calls.append("backfill_subject_keys")
+        FakeFeedsDB.done.set()
+
+    def disconnect(self):
+        pass
+
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        FakeFeedsDB.gate = threading.Event()
+        FakeFeedsDB.done = threading.Event()
+        FakeFeedsDB.calls = []
+        patcher = mock.patch.object(app_module, "MongoDBService", FakeFeedsDB)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backfill_runs_after_startup(self):
+        with TestClient(app_module.app) as client:
+            # startup is done and serving while the backfill is held
+            self.assertEqual(client.get("/").status_code, 200)
+            self.assertEqual(FakeFeedsDB.calls, ["ensure_indexes"])
+
+            FakeFeedsDB.gate.set()
+            self.assertTrue(FakeFeedsDB.done.wait(1))
+        self.assertEqual(FakeFeedsDB.calls, ["ensure_indexes", "backfill_subject_keys"])
+
+
+def make_feeds(count):
+    return [
+        {
+            "source": "lihkg",
+            "id": str(i),
+            "title": f"Thread {i} about the weekend hiking trails around Sai Kung",
+            "url": f"https://lihkg.com/thread/{i}",
+            "like_count": i,
+            "no_of_reply": 2 * i,
+            "cat_id": 1,
+        }
+        for i in range(count)
+    ]
+
+
+class TestFeedEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch("dailyprophet.readers.reader_manager.MongoDBService", FakeDB):
+            manager = ReaderManager(queue_log_dir=None)
+        self.reader = manager["TEST"]
+        self.reader.factory = FakeFactory()
+        self.reader.portfolio.load_setting([["fake", "a", 1]])
+        self.reader.push_queue(make_feeds(30))
+
+        for name, value in (
+            ("reader_manager", manager),
+            ("async_wake_up_worker", mock.AsyncMock()),
+        ):
+            patcher = mock.patch.object(app_module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        app = app_module.app
+        app.dependency_overrides[get_current_user] = lambda: "TEST"
+        self.addCleanup(app.dependency_overrides.clear)
+        self.client = TestClient(app)  # no startup, the tasks would hit the DB
+
+    def test_fields_projects_feeds(self):
+        response = self.client.get("/pop/2", params={"fields": "title, url,,missing"})
+        feeds = response.json()["feeds"]
+        self.assertEqual(len(feeds), 2)
+        for feed in feeds:
+            self.assertEqual(set(feed), {"title", "url"})
+
+    def test_card_view(self):
+        feed = self.client.get("/pop", params={"view": "card"}).json()
+        self.assertEqual(
+            set(feed),
+            {"source", "id", "title", "url", "like_count", "no_of_reply", "message"},
+        )
+
+    def test_fields_take_precedence_over_view(self):
+        feed = self.client.get("/pop", params={"fields": "id", "view": "card"}).json()
+        self.assertEqual(set(feed), {"id", "message"})
+
+    def test_full_view_by_default(self):
+        feed = self.client.get("/pop").json()
+        self.assertEqual(feed["cat_id"], 1)
+        self.assertIn("timestamp", feed)
+
+    def test_unknown_view_is_rejected(self):
+        self.assertEqual(self.client.get("/pop", params={"view": "x"}).status_code, 422)
+
+    def test_large_response_is_compressed(self):
+        response = self.client.get("/pop/20", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(response.json()["count"], 20)
+
+    def test_small_response_is_not_compressed(self):
+        response = self.client.get("/", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("content-encoding", response.headers)
+
+    def test_stream_is_uncompressed_ndjson(self):
+        response = self.client.get("/stream/35", headers={"Accept-Encoding": "gzip"})
+
+        self.assertNotIn("content-encoding", response.headers)
+        self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+        self.assertTrue(response.content.endswith(b"\n"))
+        feeds = [orjson.loads(line) for line in response.content.splitlines()]
+        self.assertEqual(len(feeds), 35)
+        self.assertEqual([feed["source"] for feed in feeds[:30]], ["lihkg"] * 30)
+        self.assertEqual({feed["source"] for feed in feeds[30:]}, {"fake/a"})
+
+    def test_stream_projects_fields(self):
+        response = self.client.get("/stream/3", params={"fields": "id"})
+        lines = response.content.splitlines()
+        self.assertEqual(
+            [orjson.loads(line) for line in lines],
+            [{"id": "0"}, {"id": "1"}, {"id": "2"}],
+        )
+
+    def test_responses_are_rendered_with_orjson(self):
+        with mock.patch.object(
+            ORJSONResponse, "render", autospec=True, side_effect=ORJSONResponse.render
+        ) as render:
+            self.assertEqual(self.client.get("/portfolio").status_code, 200)
+            self.assertEqual(self.client.get("/pop").status_code, 200)
+        self.assertEqual(render.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
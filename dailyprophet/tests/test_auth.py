@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+
+from cachetools import TTLCache
+from jose import jwt
+
+from dailyprophet import auth
+from dailyprophet.auth import get_current_user
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_token(user: str):
+    return jwt.encode({"sub": user}, auth.SECRET_KEY, algorithm="HS256")
+
+
+class TestGetCurrentUser(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        cache = TTLCache(maxsize=10, ttl=auth.TOKEN_CACHE_TTL, timer=self.clock)
+        for name, value in (
+            ("token_cache", cache),
+            ("token_cache_stats", {"hits": 0, "misses": 0}),
+        ):
+            patcher = mock.patch.object(auth, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_repeated_token_is_served_from_cache(self):
+        token = make_token("ben")
+        with mock.patch.object(auth, "decode_user", wraps=auth.decode_user) as decode:
+            self.assertEqual(await get_current_user(token), "ben")
+            self.assertEqual(await get_current_user(token), "ben")
+        decode.assert_called_once_with(token)
+        self.assertEqual(auth.token_cache_stats, {"hits": 1, "misses": 1})
+
+    async def test_cached_user_expires(self):
+        token = make_token("ben")
+        await get_current_user(token)
+        self.clock.now += auth.TOKEN_CACHE_TTL + 1
+
+        self.assertNotIn(token, auth.token_cache)
+        self.assertEqual(await get_current_user(token), "ben")
+        self.assertEqual(auth.token_cache_stats, {"hits": 0, "misses": 2})
+
+    async def test_invalid_token_is_not_cached(self):
+        for _ in range(2):
+            self.assertIsNone(await get_current_user("not-a-token"))
+        self.assertEqual(len(auth.token_cache), 0)
+        self.assertEqual(auth.token_cache_stats, {"hits": 0, "misses": 2})
+
+    async def test_token_without_subject_is_not_cached(self):
+        token = jwt.encode({"name": "ben"}, auth.SECRET_KEY, algorithm="HS256")
+        self.assertIsNone(await get_current_user(token))
+        self.assertEqual(len(auth.token_cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
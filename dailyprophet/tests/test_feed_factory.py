@@ -0,0 +1,114 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from dailyprophet.feeds.feed_factory import FeedFactory
+
+
+class FakeFeed:
+    def __init__(self, error=None):
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.release = asyncio.Event()
+        self.error = error
+
+    async def async_fetch(self, n: int):
+        self.calls.append(n)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await self.release.wait()
+        finally:
+            self.running -= 1
+        if self.error is not None:
+            raise self.error
+        return [{"source": "fake", "id": str(i)} for i in range(n)]
+
+
+class TestFeedFactory(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        FeedFactory._instance = None  # fresh singleton bound to this test's loop
+        self.factory = FeedFactory()
+        self.feed = FakeFeed()
+        self.factory._feeds["fake/a"] = self.feed
+
+    def tearDown(self):
+        FeedFactory._instance = None
+
+    async def test_joiners_share_one_fetch(self):
+        first = asyncio.ensure_future(self.factory.async_fetch("fake/a", 5))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(self.factory.async_fetch("fake/a", 3))
+        await asyncio.sleep(0)
+        self.feed.release.set()
+
+        self.assertEqual(len(await first), 5)
+        self.assertEqual(len(await second), 3)
+        self.assertEqual(self.feed.calls, [5])
+        self.assertEqual(self.factory._in_flight, {})
+
+    async def test_larger_request_starts_new_fetch(self):
+        first = asyncio.ensure_future(self.factory.async_fetch("fake/a", 2))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(self.factory.async_fetch("fake/a", 5))
+        await asyncio.sleep(0)
+        self.feed.release.set()
+
+        self.assertEqual(len(await first), 2)
+        self.assertEqual(len(await second), 5)
+        self.assertEqual(self.feed.calls, [2, 5])
+        self.assertEqual(self.factory._in_flight, {})
+
+    async def test_error_reaches_joiners_and_releases_key(self):
+        self.feed.error = ValueError("upstream down")
+        first = asyncio.ensure_future(self.factory.async_fetch("fake/a", 2))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(self.factory.async_fetch("fake/a", 2))
+        await asyncio.sleep(0)
+        self.feed.release.set()
+
+        for task in (first, second):
+            with self.assertRaises(ValueError):
+                await task
+        self.assertEqual(self.feed.calls, [2])
+        self.assertEqual(self.factory._in_flight, {})
+
+    async def test_cancelled_caller_keeps_shared_fetch(self):
+        first = asyncio.ensure_future(self.factory.async_fetch("fake/a", 2))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(self.factory.async_fetch("fake/a", 2))
+        await asyncio.sleep(0)
+
+        first.cancel()
+        await asyncio.sleep(0)
+        self.feed.release.set()
+
+        self.assertEqual(len(await second), 2)
+        self.assertTrue(first.cancelled())
+        self.assertEqual(self.feed.calls, [2])
+
+    async def test_concurrency_is_capped_across_keys(self):
+        FeedFactory._instance = None
+        with mock.patch.object(FeedFactory, "MAX_CONCURRENCY", 2):
+            factory = FeedFactory()
+        feed = FakeFeed()
+        for key in ("fake/a", "fake/b", "fake/c", "fake/d"):
+            factory._feeds[key] = feed
+
+        tasks = [
+            asyncio.ensure_future(factory.async_fetch(key, 1))
+            for key in ("fake/a", "fake/b", "fake/c", "fake/d")
+        ]
+        await asyncio.sleep(0.01)
+        self.assertEqual(feed.running, 2)
+        feed.release.set()
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(len(feed.calls), 4)
+        self.assertEqual(feed.max_running, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
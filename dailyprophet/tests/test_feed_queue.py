@@ -0,0 +1,295 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from dailyprophet.feeds.feed_queue import FeedQueue, PriorityFeedQueue
+from dailyprophet.feeds.bloom_filter import RotatingBloomFilter
+from dailyprophet.feeds.feed_item import FeedItem
+
+
+class TestFeedQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = FeedQueue()
+        self.feeds = [
+            {
+                "source": "youtube",
+                "id": "KjqpLdO3_CU",
+                "title": "HOW TO WIN AT CHESS!!!!!!!",
+            },
+            {"source": "lihkg", "url": "https://lihkg.com/thread/1", "like_count": 100},
+            {
+                "source": "openweathermap",
+                "city_name": "Hong Kong",
+                "list_0_temp_day": 25.0,
+            },
+        ]
+
+    def test_push_pop(self):
+        self.queue.push(self.feeds)
+        self.assertEqual(self.queue.size(), 3)
+
+        feed = self.queue.pop().to_dict()
+        self.assertIn(FeedQueue.timestamp_key, feed)
+        self.assertEqual(feed["id"], "KjqpLdO3_CU")
+        self.assertEqual(feed["title"], "HOW TO WIN AT CHESS!!!!!!!")
+        self.assertEqual(self.queue.size(), 2)
+        self.assertEqual(len(self.queue.set), 2)
+
+    def test_pop_many(self):
+        self.queue.push(self.feeds)
+        popped = self.queue.pop_many(2)
+        self.assertEqual([feed.source for feed in popped], ["youtube", "lihkg"])
+        self.assertEqual(self.queue.size(), 1)
+        self.assertEqual(len(self.queue.set), 1)
+
+        self.assertEqual(len(self.queue.pop_many(5)), 1)
+        self.assertEqual(self.queue.pop_many(5), [])
+        self.assertEqual(len(self.queue.set), 0)
+
+    def test_push_skips_duplicates(self):
+        self.queue.push(self.feeds)
+        self.queue.push([dict(feed, _id="mongo") for feed in self.feeds])
+        self.assertEqual(self.queue.size(), 3)
+
+    def test_pop_allows_push_again(self):
+        self.queue.push(self.feeds[:1])
+        self.queue.pop()
+        self.queue.push(self.feeds[:1])
+        self.assertEqual(self.queue.size(), 1)
+
+    def test_seen_filter_skips_served_feeds(self):
+        queue = FeedQueue(seen_filter=RotatingBloomFilter(capacity=100))
+        queue.push(self.feeds)
+        queue.pop()
+        queue.pop_many(1)
+        queue.trim_last(1)  # trimmed feeds were never served
+
+        queue.push(self.feeds)
+        self.assertEqual(queue.size(), 1)
+        self.assertEqual(queue.pop().source, "openweathermap")
+
+    def test_rotating_bloom_filter(self):
+        seen = RotatingBloomFilter(capacity=100, error_rate=0.01)
+        keys = [f"key-{i}".encode() for i in range(250)]
+        for key in keys:
+            seen.add(key)
+        # the last two generations are remembered, older keys are forgotten
+        self.assertTrue(all(key in seen for key in keys[120:]))
+        false_positives = sum(f"other-{i}".encode() in seen for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+    def test_max_size_evicts_oldest(self):
+        queue = FeedQueue(max_size=2)
+        queue.push(self.feeds)
+        self.assertEqual(queue.size(), 2)
+        self.assertEqual(len(queue.set), 2)
+        self.assertEqual(queue.pop().source, "lihkg")
+
+    def test_max_age_drops_expired(self):
+        queue = FeedQueue(max_age=timedelta(hours=1))
+        queue.push(self.feeds)
+        self.assertEqual(queue.sweep(), 0)
+
+        for item in list(queue.q)[:2]:
+            item.timestamp -= 7200
+        self.assertEqual(queue.pop().source, "openweathermap")
+        self.assertEqual(queue.size(), 0)
+        self.assertEqual(len(queue.set), 0)
+
+    def test_log_persistence(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, "TEST.log")
+            queue = FeedQueue(log_path=log_path)
+            queue.push(self.feeds)
+            queue.pop()
+            queue.close()
+
+            restored = FeedQueue(log_path=log_path)
+            self.assertEqual(restored.load(), 2)
+            with open(log_path) as f:
+                self.assertEqual(len(f.readlines()), 2)  # compacted on load
+
+            self.assertEqual(restored.set, queue.set)
+            self.assertEqual(
+                [item.to_dict() for item in restored.pop_many(2)],
+                [item.to_dict() for item in queue.q],
+            )
+            restored.close()
+
+    def test_log_compaction(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, "TEST.log")
+            queue = FeedQueue(log_path=log_path)
+            for i in range(FeedQueue.log_compact_min_records):
+                queue.push([{"source": "youtube", "id": str(i)}])
+                queue.pop()
+            queue.push(self.feeds)
+            queue.close()
+
+            with open(log_path) as f:
+                self.assertLess(len(f.readlines()), 10)
+            restored = FeedQueue(log_path=log_path)
+            self.assertEqual(restored.load(), 3)
+            restored.close()
+
+    def test_log_failure_keeps_queue_usable(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, "missing", "TEST.log")
+            queue = FeedQueue(log_path=log_path)
+            with self.assertLogs("dailyprophet.feeds.feed_queue", level="ERROR"):
+                queue.push(self.feeds)
+                self.assertEqual(len(queue.pop_many(2)), 2)
+            self.assertEqual(queue.size(), 1)
+
+    def test_no_log_skips_encoding(self):
+        with mock.patch.object(FeedItem, "to_dict") as to_dict:
+            self.queue.push(self.feeds)
+            self.queue.pop_many(2)
+        to_dict.assert_not_called()
+        self.assertEqual(self.queue.size(), 1)
+
+    def test_push_drops_mongo_id(self):
+        self.queue.push([dict(self.feeds[0], _id="mongo")])
+        self.assertNotIn("_id", self.queue.pop().to_dict())
+
+    def test_feed_item_round_trip(self):
+        self.queue.push(self.feeds)
+        for feed, item in zip(self.feeds, self.queue.pop_many(3)):
+            rendered = item.to_dict()
+            self.assertEqual(rendered.pop(FeedQueue.timestamp_key), item.timestamp)
+            self.assertEqual(rendered, feed)
+
+    def test_feed_item_projection(self):
+        self.queue.push(self.feeds)
+        youtube, lihkg, _ = self.queue.pop_many(3)
+        self.assertEqual(
+            youtube.to_dict(["title", "source"]),
+            {"title": "HOW TO WIN AT CHESS!!!!!!!", "source": "youtube"},
+        )
+        self.assertEqual(
+            lihkg.to_dict(["url", "like_count", "title"]),
+            {"url": "https://lihkg.com/thread/1", "like_count": 100},
+        )
+
+    def test_feed_item_card(self):
+        self.queue.push(self.feeds)
+        _, lihkg, weather = self.queue.pop_many(3)
+        self.assertEqual(
+            lihkg.to_card(),
+            {
+                "source": "lihkg",
+                "url": "https://lihkg.com/thread/1",
+                "like_count": 100,
+            },
+        )
+        self.assertEqual(
+            weather.to_card(), {"source": "openweathermap", "city_name": "Hong Kong"}
+        )
+
+    def test_trim_last_until(self):
+        self.queue.push(self.feeds)
+        self.assertEqual(self.queue.trim_last_until(1), 2)
+        self.assertEqual(self.queue.size(), 1)
+        self.assertEqual(len(self.queue.set), 1)
+        self.assertEqual(self.queue.pop().source, "youtube")
+
+    def test_fingerprint(self):
+        weather = self.feeds[2]
+        fingerprint = self.queue.create_fingerprint(weather)
+        self.assertEqual(len(fingerprint), 16)
+        self.assertEqual(
+            fingerprint,
+            self.queue.create_fingerprint({FeedQueue.timestamp_key: 1, **weather}),
+        )
+        self.assertNotEqual(
+            fingerprint,
+            self.queue.create_fingerprint(dict(weather, list_0_temp_day=26.0)),
+        )
+
+
+class TestPriorityFeedQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = PriorityFeedQueue()
+        self.feeds = [
+            {"source": "reddit", "id": "a", "ups": 10, "downs": 0, "num_comments": 1},
+            {
+                "source": "reddit",
+                "id": "b",
+                "ups": 3000,
+                "downs": 0,
+                "num_comments": 500,
+            },
+            {"source": "youtube", "id": "c", "publishTime": "2020-01-01T00:00:00Z"},
+            {"source": "youtube", "id": "d", "publishTime": "2030-01-01T00:00:00Z"},
+        ]
+
+    def test_pop_best_first(self):
+        self.queue.push(self.feeds)
+        popped = self.queue.pop_many(4)
+        self.assertEqual([feed.id for feed in popped], ["d", "b", "a", "c"])
+        self.assertEqual(len(self.queue.set), 0)
+
+    def test_trim_and_evict_worst(self):
+        self.queue.push(self.feeds)
+        self.assertEqual(self.queue.trim_last_until(2), 2)
+        self.assertEqual(
+            self.queue.set, {item.fingerprint for *_, item in self.queue.q}
+        )
+        self.assertEqual([feed.id for feed in self.queue.pop_many(2)], ["d", "b"])
+
+        queue = PriorityFeedQueue(max_size=1)
+        queue.push(self.feeds)
+        self.assertEqual(queue.pop().id, "d")
+
+    def test_max_age_drops_expired(self):
+        queue = PriorityFeedQueue(max_age=timedelta(hours=1))
+        queue.push(self.feeds)
+        for *_, item in queue.q:
+            if item.id != "a":
+                item.timestamp -= 7200
+        self.assertEqual(queue.pop().id, "a")
+        self.assertIsNone(queue.pop())
+
+    def test_recency_is_normalized_per_source(self):
+        now = time.time()
+        self.queue.push(
+            [
+                {"source": "openweathermap", "id": "weather"},  # no publish time
+                {"source": "reddit", "id": "fresh", "ups": 100, "created_utc": now},
+                {
+                    "source": "reddit",
+                    "id": "stale",
+                    "ups": 100,
+                    "created_utc": now - 3 * 86400,
+                },
+                {
+                    "source": "youtube",
+                    "id": "video",
+                    "publishTime": "2020-01-01T00:00:00Z",
+                },
+            ]
+        )
+        popped = [feed.id for feed in self.queue.pop_many(4)]
+        self.assertEqual(popped[0], "fresh")
+        self.assertEqual(popped[1], "weather")
+        self.assertEqual(set(popped[2:]), {"stale", "video"})
+
+    def test_pop_many_logs_once(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, "TEST.log")
+            queue = PriorityFeedQueue(log_path=log_path)
+            queue.push(self.feeds)
+            queue.pop_many(3)
+            queue.close()
+
+            with open(log_path) as f:
+                self.assertEqual(len(f.readlines()), len(self.feeds) + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
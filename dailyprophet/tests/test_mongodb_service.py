@@ -0,0 +1,161 @@
+import asyncio
+import os
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from pymongo import MongoClient
+
+from dailyprophet.mongodb_service import MongoDBService
+from dailyprophet.feeds.reddit import RedditFeed
+
+TEST_MONGODB_URI = os.environ.get("DAILYPROPHET_TEST_MONGODB_URI")
+
+
+def plan_stages(plan):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"], plan.get("indexName")
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+@unittest.skipUnless(TEST_MONGODB_URI, "DAILYPROPHET_TEST_MONGODB_URI is not set")
+class TestFeedsIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MongoDBService("feeds")
+        self.db.client = MongoClient(TEST_MONGODB_URI, serverSelectionTimeoutMS=2000)
+        self.db.db_name = "dailyprophet_test"
+        self.collection = self.db.client[self.db.db_name]["feeds"]
+        self.collection.drop()
+
+        now = int(datetime.utcnow().timestamp())
+        self.collection.insert_many(
+            [
+                {
+                    "source": "reddit",
+                    "subject": subject,
+                    "id": f"{subject}{i}",
+                    "ups": i,
+                    "downs": 0,
+                    "num_comments": 0,
+                    "expire_time": now + (i - 10) * 60,
+                }
+                for subject in (" Programming", "python", "rust")
+                for i in range(20)
+            ]
+        )
+        self.db.ensure_indexes()
+        self.db.backfill_subject_keys()
+        self.now = now
+
+    def tearDown(self):
+        self.db.client.drop_database(self.db.db_name)
+        self.db.disconnect()
+
+    def test_backfill_subject_keys(self):
+        self.assertEqual(
+            self.collection.count_documents({"subject_key": "programming"}), 20
+        )
+        self.assertEqual(self.db.backfill_subject_keys(), 0)
+
+    def test_backfill_scoped_to_subject(self):
+        self.collection.insert_many(
+            [
+                {"source": "reddit", "subject": "Python "},
+                {"source": "reddit", "subject": "pythonic"},
+                {"source": "arxiv", "subject": "python"},
+            ]
+        )
+        self.assertEqual(self.db.backfill_subject_keys("reddit", "python"), 1)
+        self.assertEqual(
+            self.collection.count_documents({"subject_key": {"$exists": False}}), 2
+        )
+
+    def test_cache_query_uses_index(self):
+        criteria = RedditFeed("Programming").cache_criteria({"$gte": self.now})
+        self.assertEqual(len(self.db.query(criteria)), 10)
+
+        explain = self.collection.find(criteria).explain()
+        stages = list(plan_stages(explain["queryPlanner"]["winningPlan"]))
+        self.assertIn(
+            ("IXSCAN", "source_1_subject_key_1_expire_time_1"),
+            stages,
+        )
+        self.assertNotIn("COLLSCAN", [stage for stage, _ in stages])
+
+    def test_cache_pipeline_ranks_valid_first(self):
+        pipeline = RedditFeed("Programming").cache_pipeline(self.now, 12)
+        posts = self.db.aggregate(pipeline)
+
+        self.assertEqual(
+            [post["id"] for post in posts],
+            [
+                f" Programming{i}"
+                for i in [19, 18, 17, 16, 15, 14, 13, 12, 11, 10, 9, 8]
+            ],
+        )
+        self.assertEqual(sum(post["_is_valid"] for post in posts), 10)
+        self.assertNotIn("_id", posts[0])
+
+
+class TestAsyncCalls(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        patcher = mock.patch("dailyprophet.mongodb_service.MongoClient")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = MongoDBService("feeds")
+        self.addCleanup(self.db.disconnect)
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def blocking_call(self, value):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.02)  # a DB round trip
+        with self.lock:
+            self.running -= 1
+        return value
+
+    async def test_executor_is_created_lazily(self):
+        self.assertIsNone(self.db._executor)
+        self.assertEqual(await self.db._run_async(self.blocking_call, 1), 1)
+        self.assertIsNotNone(self.db._executor)
+
+    async def test_pending_calls_are_bounded(self):
+        with mock.patch.object(MongoDBService, "MAX_PENDING", 2):
+            results = await asyncio.gather(
+                *(self.db._run_async(self.blocking_call, i) for i in range(8))
+            )
+        self.assertEqual(results, list(range(8)))
+        self.assertEqual(self.max_running, 2)
+
+    async def test_calls_do_not_block_the_loop(self):
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        await asyncio.gather(
+            *(self.db._run_async(self.blocking_call, i) for i in range(16))
+        )
+        ticker.cancel()
+        self.assertGreater(ticks, 2)
+        self.assertGreater(self.max_running, 1)  # spread over the I/O threads
+
+
+if __name__ == "__main__":
+    unittest.main()
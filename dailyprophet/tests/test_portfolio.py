@@ -0,0 +1,60 @@
+import unittest
+from collections import Counter
+
+from dailyprophet.feeds.portfolio import FeedPortfolio
+
+
+class TestFeedPortfolio(unittest.TestCase):
+
+    def setUp(self):
+        self.setting = [
+            ["reddit", "programming", 0.6],
+            ["arxiv", "cs.LG", 0.3],
+            ["openweathermap", "Hong Kong", 0.1],
+        ]
+        self.portfolio = FeedPortfolio("TEST", self.setting)
+
+    def test_sample_keys_follows_weights(self):
+        n = 20000
+        counts = Counter(self.portfolio.sample_keys(n))
+        self.assertEqual(sum(counts.values()), n)
+        for feed_type, name, weight in self.setting:
+            key = f"{feed_type}/{name}"
+            self.assertAlmostEqual(counts[key] / n, weight, delta=0.02)
+
+    def test_sample_keys_invalidated_on_change(self):
+        self.portfolio.sample_keys(1)
+        self.portfolio.load_setting([["reddit", "python", 1.0]])
+        self.assertEqual(set(self.portfolio.sample_keys(10)), {"reddit/python"})
+
+        self.portfolio.add("arxiv", "cs.AI", 0.0)
+        self.assertEqual(set(self.portfolio.sample_keys(10)), {"reddit/python"})
+
+    def test_dirty_on_change(self):
+        self.assertFalse(self.portfolio.dirty)
+        self.portfolio.sample_keys(10)
+        self.assertFalse(self.portfolio.dirty)
+
+        self.portfolio.add("arxiv", "cs.AI", 0.2)
+        self.assertTrue(self.portfolio.dirty)
+
+        self.portfolio.dirty = False
+        self.portfolio.load_default()
+        self.assertTrue(self.portfolio.dirty)
+
+    def test_sample_keys_exclude(self):
+        keys = self.portfolio.sample_keys(100, exclude={"reddit/programming"})
+        self.assertEqual(len(keys), 100)
+        self.assertNotIn("reddit/programming", keys)
+
+        all_keys = [f"{feed_type}/{name}" for feed_type, name, _ in self.setting]
+        self.assertEqual(self.portfolio.sample_keys(10, exclude=all_keys), [])
+
+    def test_sample_keys_empty(self):
+        self.portfolio.load_setting([])
+        self.assertEqual(len(self.portfolio), 0)
+        self.assertEqual(self.portfolio.sample_keys(5), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
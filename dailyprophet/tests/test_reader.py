@@ -1,8 +1,313 @@
+from collections import Counter
 import asyncio
+import itertools
+import unittest
+from unittest import mock
 
+from dailyprophet.feeds.feed_factory import FeedFactory
 from dailyprophet.readers.reader import Reader
 
 
+class FakeFactory:
+    """
+    Stands in for FeedFactory: per-key delays and caps on the number of feeds
+    """
+
+    def __init__(self, delays=None, limits=None):
+        self.delays = delays or {}
+        self.limits = limits or {}
+        self.calls = []
+        self.cancelled = []
+        self.ids = itertools.count()
+
+    async def async_fetch(self, key: str, n: int):
+        self.calls.append((key, n))
+        try:
+            await asyncio.sleep(self.delays.get(key, 0))
+        except asyncio.CancelledError:
+            self.cancelled.append(key)
+            raise
+        count = min(n, self.limits.get(key, n))
+        return [{"source": key, "id": str(next(self.ids))} for _ in range(count)]
+
+
+class FakeFeed:
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.cancelled = 0
+
+    async def async_fetch(self, n: int):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return [{"source": "fake", "id": str(i)} for i in range(n)]
+
+
+def make_reader(setting, **kwargs):
+    reader = Reader("TEST", record={"portfolio": setting})
+    reader.factory = FakeFactory(**kwargs)
+    return reader
+
+
+class TestReaderSample(unittest.IsolatedAsyncioTestCase):
+
+    async def test_budget_returns_partial_and_backfills(self):
+        reader = make_reader(
+            [["fake", "fast", 1], ["fake", "slow", 1]], delays={"fake/slow": 0.1}
+        )
+        feeds = await reader.async_sample(40, budget=0.03)
+
+        self.assertTrue(feeds)
+        self.assertEqual({feed["source"] for feed in feeds}, {"fake/fast"})
+        self.assertEqual(reader.queue.size(), 0)
+
+        await asyncio.sleep(0.15)
+        self.assertGreater(reader.queue.size(), 0)
+        sources = {feed.source for feed in reader.queue.pop_many(100)}
+        self.assertEqual(sources, {"fake/slow"})
+        self.assertFalse(reader.is_busy())
+
+    async def test_hard_timeout_cancels_stragglers(self):
+        reader = make_reader(
+            [["fake", "fast", 1], ["fake", "hung", 1]], delays={"fake/hung": 10}
+        )
+        await reader.async_sample(40, budget=0.03, hard_timeout=0.06)
+        self.assertTrue(reader.is_busy())
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(reader.factory.cancelled, ["fake/hung"])
+        self.assertEqual(reader.queue.size(), 0)
+        self.assertFalse(reader.is_busy())
+
+    async def test_new_pushes_batches_as_they_arrive(self):
+        reader = make_reader(
+            [["fake", "fast", 1], ["fake", "hung", 1]], delays={"fake/hung": 10}
+        )
+        new = asyncio.ensure_future(reader.async_new(40, budget=3.0))
+        await asyncio.sleep(0.05)
+
+        self.assertFalse(new.done())
+        self.assertGreater(reader.queue.size(), 0)
+
+        new.cancel()
+        await asyncio.sleep(0)
+        for task in list(reader._backfill_tasks):
+            task.cancel()
+
+    async def test_hung_upstream_fetch_is_released(self):
+        FeedFactory._instance = None  # real factory bound to this test's loop
+        self.addCleanup(setattr, FeedFactory, "_instance", None)
+        reader = Reader("TEST", record={"portfolio": [["fake", "hung", 1]]})
+        hung = FakeFeed(delay=10)
+        reader.factory._feeds["fake/hung"] = hung
+
+        with mock.patch.object(FeedFactory, "FETCH_TIMEOUT", 0.05):
+            await reader.async_sample(10, budget=0.01, hard_timeout=0.05)
+            await asyncio.sleep(0.1)
+
+        self.assertEqual(hung.cancelled, 1)
+        self.assertEqual(reader.factory._in_flight, {})
+        self.assertEqual(
+            reader.factory._fetch_semaphore._value, FeedFactory.MAX_CONCURRENCY
+        )
+
+        reader.factory._feeds["fake/hung"] = FakeFeed()  # the source recovers
+        self.assertEqual(len(await reader.async_sample(10)), 10)
+
+
+class TestReaderStream(unittest.IsolatedAsyncioTestCase):
+
+    async def test_stream_yields_queued_then_fresh(self):
+        reader = make_reader([["fake", "fresh", 1]])
+        reader.push_queue([{"source": "queued", "id": "q"}])
+
+        feeds = [feed async for feed in reader.async_stream(5)]
+        self.assertEqual([feed.source for feed in feeds][0], "queued")
+        self.assertEqual(len(feeds), 5)
+
+    async def test_stream_served_from_queue_alone(self):
+        reader = make_reader([["fake", "fresh", 1]])
+        reader.push_queue([{"source": "queued", "id": str(i)} for i in range(5)])
+
+        feeds = [feed async for feed in reader.async_stream(3)]
+        self.assertEqual([feed.id for feed in feeds], ["0", "1", "2"])
+        self.assertEqual(reader.factory.calls, [])
+        self.assertEqual(reader.queue.size(), 2)
+
+    async def test_stream_yields_fast_sources_first(self):
+        reader = make_reader(
+            [["fake", "fast", 1], ["fake", "slow", 1]], delays={"fake/slow": 0.1}
+        )
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        arrivals = []
+        async for feed in reader.async_stream(40):
+            arrivals.append((feed.source, loop.time() - start))
+
+        self.assertEqual(arrivals[0][0], "fake/fast")
+        self.assertLess(arrivals[0][1], 0.05)
+        self.assertEqual(len(arrivals), 40)
+
+    async def test_stream_skips_feeds_already_served(self):
+        reader = make_reader([["fake", "fresh", 1]])
+        served = {"source": "fake/fresh", "id": "0"}
+        reader.push_queue([served])
+        reader.queue.pop()
+
+        feeds = [feed async for feed in reader.async_stream(5)]
+        self.assertEqual(sorted(feed.id for feed in feeds), ["1", "2", "3", "4"])
+
+
+class TestReaderReallocation(unittest.IsolatedAsyncioTestCase):
+
+    async def test_shortfall_is_reallocated(self):
+        reader = make_reader(
+            [["fake", "full", 1], ["fake", "empty", 3]], limits={"fake/empty": 0}
+        )
+        feeds = await reader.async_sample(30)
+
+        self.assertEqual(len(feeds), 30)
+        self.assertEqual({feed["source"] for feed in feeds}, {"fake/full"})
+
+    async def test_reallocation_rounds_are_bounded(self):
+        reader = make_reader(
+            [["fake", "thin", 1], ["fake", "empty", 1]],
+            limits={"fake/thin": 2, "fake/empty": 0},
+        )
+        feeds = await reader.async_sample(30)
+
+        self.assertLess(len(feeds), 30)
+        max_calls = 2 * (Reader.MAX_REALLOCATION_ROUNDS + 1)  # keys per round
+        self.assertLessEqual(len(reader.factory.calls), max_calls)
+
+    async def test_exhausted_key_is_not_redrawn(self):
+        reader = make_reader(
+            [["fake", "full", 1], ["fake", "empty", 1]], limits={"fake/empty": 0}
+        )
+        await reader.async_sample(30)
+
+        keys = [key for key, _ in reader.factory.calls]
+        self.assertEqual(keys.count("fake/empty"), 1)
+
+    async def test_shortfall_is_redrawn_by_weight(self):
+        reader = make_reader(
+            [["fake", "heavy", 9], ["fake", "light", 1], ["fake", "empty", 10]],
+            limits={"fake/empty": 0},
+        )
+        feeds = await reader.async_sample(1000)
+
+        self.assertEqual(len(feeds), 1000)
+        counts = Counter(feed["source"] for feed in feeds)
+        self.assertGreater(counts["fake/heavy"], 4 * counts["fake/light"])
+
+
+class TestRefillCoordinator(unittest.IsolatedAsyncioTestCase):
+
+    async def test_one_refill_at_a_time(self):
+        reader = make_reader([["fake", "a", 1]], delays={"fake/a": 0.02})
+        self.assertTrue(reader.refill())
+        self.assertFalse(reader.refill())
+        self.assertTrue(reader.refill_coordinator.is_refilling())
+
+        await reader.refill_coordinator.task
+        self.assertEqual(len(reader.factory.calls), 1)
+        self.assertEqual(reader.queue.size(), Reader.MIN_REFILL_SIZE)
+        self.assertFalse(reader.refill())  # above the low-water mark
+
+    async def test_pop_waits_for_refill(self):
+        reader = make_reader([["fake", "a", 1]], delays={"fake/a": 0.02})
+        reader.refill()
+        feed = await reader.async_pop()
+        self.assertIsNotNone(feed)
+
+    async def test_pop_returns_once_fast_sources_arrive(self):
+        reader = make_reader(
+            [["fake", "fast", 1], ["fake", "slow", 1]],
+            delays={"fake/fast": 0.05, "fake/slow": 10},
+        )
+        loop = asyncio.get_running_loop()
+        reader.refill()
+        start = loop.time()
+        feed = await reader.async_pop()
+
+        self.assertEqual(feed.source, "fake/fast")
+        self.assertLess(loop.time() - start, 0.5)
+
+        reader.refill_coordinator.task.cancel()
+        await asyncio.sleep(0)
+        for task in list(reader._backfill_tasks):
+            task.cancel()
+
+    async def test_hung_source_does_not_hold_refill(self):
+        reader = make_reader(
+            [["fake", "fast", 1], ["fake", "hung", 1]], delays={"fake/hung": 10}
+        )
+        with mock.patch.object(Reader, "LATENCY_BUDGET", 0.03):
+            reader.refill()
+            await asyncio.wait_for(reader.refill_coordinator.task, timeout=1)
+        self.assertGreater(reader.queue.size(), 0)
+        self.assertFalse(reader.refill_coordinator.is_refilling())
+
+        for task in list(reader._backfill_tasks):
+            task.cancel()
+
+
+class TestPopRate(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = make_reader([["fake", "a", 1]])
+        self.clock = mock.patch("dailyprophet.readers.reader.time.monotonic")
+        self.monotonic = self.clock.start()
+        self.monotonic.return_value = 0.0
+        self.reader._pop_count_time = 0.0
+
+    def tearDown(self):
+        self.clock.stop()
+
+    def test_idle_reader_uses_minimums(self):
+        self.assertEqual(self.reader.pop_rate(), 0)
+        self.assertEqual(self.reader.refill_size(), Reader.MIN_REFILL_SIZE)
+        self.assertEqual(self.reader.low_water_mark(), Reader.MIN_LOW_WATER_MARK)
+
+    def test_pop_rate_decays(self):
+        self.reader.record_pops(50)
+        self.assertAlmostEqual(self.reader.pop_rate(), 10.0)  # per minute
+        self.assertEqual(self.reader.refill_size(), 50)
+        self.assertEqual(self.reader.low_water_mark(), 10)
+
+        self.monotonic.return_value = Reader.POP_RATE_TIME_CONSTANT * 60
+        self.assertAlmostEqual(self.reader.pop_rate(), 10.0 / 2.718281828, places=3)
+
+    def test_heavy_reader_is_capped(self):
+        self.reader.record_pops(10000)
+        self.assertEqual(self.reader.refill_size(), Reader.MAX_REFILL_SIZE)
+        self.assertEqual(self.reader.low_water_mark(), Reader.MAX_LOW_WATER_MARK)
+
+
+class TestAdaptiveRefill(unittest.IsolatedAsyncioTestCase):
+
+    async def test_pops_are_recorded(self):
+        reader = make_reader([["fake", "a", 1]])
+        reader.push_queue([{"source": "queued", "id": str(i)} for i in range(10)])
+        await reader.async_pop_many(3)
+        await reader.async_pop()
+
+        expected = 4 / Reader.POP_RATE_TIME_CONSTANT
+        self.assertAlmostEqual(reader.pop_rate(), expected, places=3)
+
+    async def test_heavy_reader_refills_earlier_and_more(self):
+        reader = make_reader([["fake", "a", 1]])
+        reader.push_queue([{"source": "queued", "id": str(i)} for i in range(20)])
+        self.assertFalse(reader.refill())  # above the minimum low-water mark
+
+        reader.record_pops(10000)
+        self.assertTrue(reader.refill())
+        await reader.refill_coordinator.task
+        self.assertEqual(reader.factory.calls, [("fake/a", Reader.MAX_REFILL_SIZE)])
+
+
 async def main():
     reader = Reader("BL")
     out = await reader.async_sample(50)
@@ -0,0 +1,185 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+from dailyprophet.readers.reader_manager import ReaderManager
+
+
+class FakeDB:
+    """
+    Stands in for MongoDBService on the readers collection
+    """
+
+    def __init__(self, collection: str):
+        self.records = {}
+        self.reads = []
+        self.writes = []  # ids per bulk write
+        self.gate = None  # set to a threading.Event to hold writes
+        self.error = None
+
+    def read(self, key, key_field="_id"):
+        self.reads.append(key)
+        return self.records.get(key, {})
+
+    def bulk_save(self, records: dict, key_field="_id"):
+        if self.gate is not None:
+            self.gate.wait(1)
+        if self.error is not None:
+            raise self.error
+        self.writes.append(sorted(records))
+        self.records.update(records)
+
+
+class TestReaderManager(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        patcher = mock.patch(
+            "dailyprophet.readers.reader_manager.MongoDBService", FakeDB
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = ReaderManager(max_readers=3, idle_timeout=60)
+        self.db = self.manager.db
+        self.manager.sync()  # the default reader is new to the fake DB
+        self.db.writes.clear()
+
+    async def test_only_default_reader_loaded_at_start(self):
+        self.assertEqual(list(self.manager._readers), ["PUBLIC"])
+        self.assertEqual(self.db.reads, ["PUBLIC"])
+
+    async def test_concurrent_first_requests_share_one_load(self):
+        readers = await asyncio.gather(*(self.manager.async_get("a") for _ in range(3)))
+        self.assertTrue(all(reader is readers[0] for reader in readers))
+        self.assertEqual(self.db.reads.count("a"), 1)
+        self.assertEqual(self.manager._loading, {})
+
+    async def test_load_does_not_block_the_loop(self):
+        def slow_read(key, key_field="_id"):
+            time.sleep(0.05)  # a DB round trip
+            return {}
+
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        self.db.read = slow_read
+        ticker = asyncio.ensure_future(tick())
+        await self.manager.async_get("a")
+        ticker.cancel()
+        self.assertGreater(ticks, 3)
+
+    async def test_stored_reader_keeps_portfolio(self):
+        self.db.records["a"] = {"userId": "a", "portfolio": [["arxiv", "cs.LG", 1.0]]}
+        reader = await self.manager.async_get("a")
+        self.assertEqual(reader.portfolio.get_setting(), [["arxiv", "cs.LG", 1.0]])
+        self.assertFalse(reader.portfolio.dirty)
+
+    async def test_evicts_least_recently_used_over_capacity(self):
+        for id in ("a", "b"):
+            await self.manager.async_get(id)
+        await self.manager.async_get("a")  # b is now least recently used
+        await self.manager.async_get("c")
+        self.assertEqual(list(self.manager._readers), ["PUBLIC", "a", "c"])
+
+    async def test_evicts_idle_readers_on_sweep(self):
+        await self.manager.async_get("a")
+        await self.manager.async_get("b")
+        self.manager._last_access["a"] -= 120
+        self.manager._last_access["PUBLIC"] -= 120  # never evicted
+
+        self.manager.sweep()
+        self.assertEqual(list(self.manager._readers), ["PUBLIC", "b"])
+
+    async def test_busy_reader_is_kept(self):
+        reader = await self.manager.async_get("a")
+        self.manager._last_access["a"] -= 120
+        with mock.patch.object(reader, "is_busy", return_value=True):
+            self.assertEqual(self.manager.evict(), 0)
+        self.assertEqual(self.manager.evict(), 1)
+
+    async def test_evicted_reader_reloads_with_its_changes(self):
+        reader = await self.manager.async_get("a")
+        reader.portfolio.load_setting([["reddit", "python", 1.0]])
+        self.manager._last_access["a"] -= 120
+        self.manager.evict()
+
+        reloaded = await self.manager.async_get("a")
+        self.assertIsNot(reloaded, reader)
+        self.assertEqual(reloaded.portfolio.get_setting(), [["reddit", "python", 1.0]])
+        self.assertEqual(self.db.reads.count("a"), 1)  # served from pending
+
+    async def test_new_reader_is_written_behind(self):
+        await self.manager.async_get("a")
+        self.assertEqual(self.db.writes, [])
+
+        self.assertEqual(await self.manager.async_sync(), 1)
+        self.assertEqual(self.db.writes, [["a"]])
+        self.assertEqual(await self.manager.async_sync(), 0)
+
+    async def test_records_in_flight_stay_visible(self):
+        reader = await self.manager.async_get("a")
+        self.manager.sync()
+        reader.portfolio.load_setting([["reddit", "python", 1.0]])
+
+        self.db.gate = threading.Event()
+        syncing = asyncio.ensure_future(self.manager.async_sync())
+        await asyncio.sleep(0.02)  # the write is in flight
+
+        self.manager._last_access["a"] -= 120
+        self.manager.evict()
+        reloaded = await self.manager.async_get("a")
+        self.assertEqual(reloaded.portfolio.get_setting(), [["reddit", "python", 1.0]])
+
+        self.db.gate.set()
+        await syncing
+        self.assertEqual(self.manager._pending, {})
+        self.assertEqual(self.db.records["a"]["portfolio"], [["reddit", "python", 1.0]])
+
+    async def test_records_are_collected_on_the_loop(self):
+        reader = await self.manager.async_get("a")
+        self.db.gate = threading.Event()
+        syncing = asyncio.ensure_future(self.manager.async_sync())
+        await asyncio.sleep(0.02)  # the write is in flight
+
+        # serializing already happened, a change now is kept for the next sync
+        reader.portfolio.load_setting([["reddit", "python", 1.0]])
+        self.assertTrue(reader.portfolio.dirty)
+
+        self.db.gate.set()
+        self.assertEqual(await syncing, 1)
+        self.assertEqual(await self.manager.async_sync(), 1)
+        self.assertEqual(self.db.records["a"]["portfolio"], [["reddit", "python", 1.0]])
+
+    async def test_serialize_runs_on_the_calling_thread(self):
+        await self.manager.async_get("a")
+        threads = []
+        serialize = self.manager.serialize
+
+        def record_thread(readers=None):
+            threads.append(threading.current_thread())
+            return serialize(readers)
+
+        with mock.patch.object(self.manager, "serialize", record_thread):
+            await self.manager.async_sync()
+        self.assertEqual(threads, [threading.main_thread()])
+
+    async def test_failed_write_is_retried(self):
+        await self.manager.async_get("a")
+        self.db.error = ConnectionError("Atlas unreachable")
+        self.assertEqual(self.manager.sync(), 0)
+        self.assertIn("a", self.manager._pending)
+
+        self.db.error = None
+        self.assertEqual(self.manager.sync(), 1)
+        self.assertEqual(self.manager._pending, {})
+        self.assertIn("a", self.db.records)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from dailyprophet.feeds import reddit
+from dailyprophet.feeds.reddit import RedditFeed, candidate_cache
+
+
+class FakeFeedsDB:
+    """
+    Stands in for MongoDBService on the feeds collection, returning posts as
+    ranked by the cache pipeline
+    """
+
+    def __init__(self, posts):
+        self.posts = posts
+        self.aggregations = []
+        self.backfills = []
+
+    async def async_aggregate(self, pipeline):
+        self.aggregations.append(pipeline)
+        limit = next(stage["$limit"] for stage in pipeline if "$limit" in stage)
+        return [dict(post) for post in self.posts[:limit]]
+
+    async def async_backfill_subject_keys(self, source=None, subject=None):
+        self.backfills.append((source, subject))
+
+
+def make_posts(count, valid, expire_time):
+    return [
+        {
+            "source": "reddit",
+            "id": str(i),
+            "_is_valid": i < valid,
+            "expire_time": expire_time if i < valid else 0,
+        }
+        for i in range(count)
+    ]
+
+
+class TestRedditCandidateCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        candidate_cache.clear()
+        self.addCleanup(candidate_cache.clear)
+        self.now = reddit.utc_timestamp()
+        self.db = FakeFeedsDB(make_posts(40, 30, self.now + 600))
+        for name, value in (
+            ("db", self.db),
+            ("async_worker_fetch", mock.AsyncMock()),
+        ):
+            patcher = mock.patch.object(reddit, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_subject_served_from_memory(self):
+        first = await RedditFeed("python").async_fetch(5)
+        second = await RedditFeed(" Python").async_fetch(10)
+
+        self.assertEqual(len(first), 5)
+        self.assertEqual(len(second), 10)
+        self.assertEqual(len(self.db.aggregations), 1)
+        self.assertNotIn("_is_valid", second[0])
+        self.assertNotIn("expire_time", second[0])
+
+    async def test_larger_request_requeries_full_window(self):
+        self.db.posts = make_posts(200, 200, self.now + 600)
+        await RedditFeed("python").async_fetch(5)
+        posts = await RedditFeed("python").async_fetch(120)
+
+        self.assertEqual(len(posts), 120)
+        self.assertEqual(len(self.db.aggregations), 2)
+
+    async def test_expires_with_first_valid_post(self):
+        self.db.posts = make_posts(40, 30, self.now + 0.05)
+        await RedditFeed("python").async_fetch(5)
+        await asyncio.sleep(0.1)
+        await RedditFeed("python").async_fetch(5)
+
+        self.assertEqual(len(self.db.aggregations), 2)
+
+    async def test_fill_invalidates_cache(self):
+        self.db.posts = make_posts(10, 2, self.now + 600)
+        feed = RedditFeed("python")
+        await feed.async_fetch(5)  # short of valid posts, triggers a fill
+        await asyncio.sleep(0)
+
+        reddit.async_worker_fetch.assert_awaited_once_with("reddit", "python", 30)
+        self.assertEqual(self.db.backfills, [("reddit", "python")])
+        self.assertNotIn(("reddit", "python"), candidate_cache)
+
+        await feed.async_fetch(5)
+        self.assertEqual(len(self.db.aggregations), 2)
+
+    async def test_posts_without_expire_time(self):
+        self.db.posts = [{"source": "reddit", "id": "a", "_is_valid": False}]
+        posts = await RedditFeed("python").async_fetch(1)
+        self.assertEqual(posts, [{"source": "reddit", "id": "a"}])
+
+
+if __name__ == "__main__":
+    unittest.main()